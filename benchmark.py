@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import sqlite3
+import argparse
+import collections
+import tempfile
+import subprocess
+import importlib.util
+import importlib.machinery
+import unittest.mock
+import trio
+import pyfuse3
+import sqlfs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SQLFS_SCRIPT = os.path.join(HERE, 'sqlfs')
+
+VARIANTS = ('memory', 'file', 'encrypted')
+WORKLOADS = ('seq_write', 'seq_read', 'rand_write', 'rand_read', 'create_delete', 'stat', 'listdir')
+
+# entries per readdir call when there is no kernel to fill a buffer
+READDIR_BATCH = 128
+
+
+def load_script():
+    # the sqlfs script has no .py extension, load it to reuse its option parsing
+    loader = importlib.machinery.SourceFileLoader('sqlfs_script', SQLFS_SCRIPT)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    script = importlib.util.module_from_spec(spec)
+    loader.exec_module(script)
+    return script
+
+
+def sqlcipher_loaded():
+    conn = sqlite3.connect(':memory:')
+    try:
+        return conn.execute('PRAGMA cipher_version').fetchone() is not None
+    finally:
+        conn.close()
+
+
+def readdir_reply(token, name, entry, next_id):
+    if len(token) >= READDIR_BATCH:
+        return False
+    token.append((next_id, name, entry.st_ino))
+    return True
+
+
+class OpsTarget:
+    # calls sqlfs.Operations directly, the way the kernel would
+
+    def __init__(self, db_path, key, options):
+        self.ops = sqlfs.Operations(db_path, key, **options)
+        self.ctx = types.SimpleNamespace(uid=os.getuid(), gid=os.getgid(), pid=os.getpid(), umask=0o022)
+        self.inodes = {}
+        # lookups the kernel would hold on each inode, forgotten on unlink
+        self.lookups = collections.Counter()
+        self.patch = unittest.mock.patch.object(sqlfs.pyfuse3, 'readdir_reply', readdir_reply)
+        self.patch.start()
+
+    async def create(self, name):
+        fi, entry = await self.ops.create(pyfuse3.ROOT_INODE, name, 0o100644, os.O_RDWR, self.ctx)
+        self.inodes[name] = entry.st_ino
+        self.lookups[entry.st_ino] += 1
+        return fi.fh
+
+    async def open(self, name):
+        fi = await self.ops.open(self.inodes[name], os.O_RDWR, self.ctx)
+        return fi.fh
+
+    async def write(self, fh, off, data):
+        await self.ops.write(fh, off, data)
+
+    async def read(self, fh, off, size):
+        return await self.ops.read(fh, off, size)
+
+    async def close(self, fh):
+        await self.ops.flush(fh)
+        await self.ops.release(fh)
+
+    async def drop_caches(self, fh):
+        self.ops.cache.discard(self.ops.handles[fh].inode)
+
+    async def stat(self, name):
+        return await self.ops.getattr(self.inodes[name], self.ctx)
+
+    async def unlink(self, name):
+        await self.ops.unlink(pyfuse3.ROOT_INODE, name, self.ctx)
+        inode = self.inodes.pop(name)
+        await self.ops.forget([(inode, self.lookups.pop(inode))])
+
+    async def listdir(self):
+        count, start_id = 0, 0
+        fh = await self.ops.opendir(pyfuse3.ROOT_INODE, self.ctx)
+        while True:
+            token = []
+            await self.ops.readdir(fh, start_id, token)
+            if not token:
+                return count
+            count += len(token)
+            # readdir looks up everything it lists except . and ..
+            self.lookups.update(inode for _, name, inode in token if name not in (b'.', b'..'))
+            start_id = token[-1][0]
+
+    def close_target(self):
+        self.patch.stop()
+        self.ops.close()
+
+
+class FuseTarget:
+    # mounts the sqlfs script and goes through the kernel
+
+    def __init__(self, db_path, key, options, tmp):
+        self.mnt = os.path.join(tmp, 'mnt')
+        os.mkdir(self.mnt)
+        cmd = [sys.executable, SQLFS_SCRIPT, '-f']
+        for opt in options:
+            cmd.extend(['-o', opt])
+        if key is not None:
+            cmd.extend(['-o', f'password={key}'])
+        if db_path != ':memory:':
+            cmd.append(db_path)
+        cmd.append(self.mnt)
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while not os.path.ismount(self.mnt):
+            if self.proc.poll() is not None or time.monotonic() > deadline:
+                self.proc.kill()
+                raise RuntimeError('mount failed')
+            time.sleep(0.1)
+
+    def path(self, name):
+        return os.path.join(self.mnt, os.fsdecode(name))
+
+    async def create(self, name):
+        return os.open(self.path(name), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    async def open(self, name):
+        return os.open(self.path(name), os.O_RDWR)
+
+    async def write(self, fh, off, data):
+        os.pwrite(fh, data, off)
+
+    async def read(self, fh, off, size):
+        return os.pread(fh, size, off)
+
+    async def close(self, fh):
+        os.close(fh)
+
+    async def drop_caches(self, fh):
+        os.posix_fadvise(fh, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    async def stat(self, name):
+        return os.stat(self.path(name))
+
+    async def unlink(self, name):
+        os.unlink(self.path(name))
+
+    async def listdir(self):
+        # like ls -l
+        count = 0
+        with os.scandir(self.mnt) as it:
+            for entry in it:
+                entry.stat(follow_symlinks=False)
+                count += 1
+        return count
+
+    def close_target(self):
+        subprocess.run(['fusermount', '-u', self.mnt], check=False)
+        self.proc.wait(timeout=30)
+        os.rmdir(self.mnt)
+
+
+def summary(latencies, seconds, nbytes=0):
+    latencies = sorted(latencies)
+    result = {
+        'ops': len(latencies),
+        'seconds': seconds,
+        'ops_per_s': len(latencies) / seconds if seconds else None,
+        'latency_us': {
+            'mean': sum(latencies) / len(latencies) / 1e3,
+            'p50': latencies[len(latencies) // 2] / 1e3,
+            'p99': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] / 1e3,
+        },
+    }
+    if nbytes:
+        result['mb_per_s'] = nbytes / seconds / (1 << 20) if seconds else None
+    return result
+
+
+async def timed(calls):
+    latencies = []
+    start = sqlfs._perf_counter_ns()
+    for call, args in calls:
+        t0 = sqlfs._perf_counter_ns()
+        await call(*args)
+        latencies.append(sqlfs._perf_counter_ns() - t0)
+    return latencies, (sqlfs._perf_counter_ns() - start) / 1e9
+
+
+async def io_workload(target, workload, io_size, file_size):
+    name = b'bench-%s-%d' % (workload.encode(), io_size)
+    count = file_size // io_size
+    offsets = [i * io_size for i in range(count)]
+    if workload.startswith('rand'):
+        random.Random(io_size).shuffle(offsets)
+    data = os.urandom(io_size)
+    fh = await target.create(name)
+    if workload.endswith('read'):
+        for off in range(0, file_size, io_size):
+            await target.write(fh, off, data)
+        await target.close(fh)
+        fh = await target.open(name)
+        await target.drop_caches(fh)
+        calls = [(target.read, (fh, off, io_size)) for off in offsets]
+    else:
+        calls = [(target.write, (fh, off, data)) for off in offsets]
+    latencies, seconds = await timed(calls)
+    # writes only count once they are flushed
+    t0 = sqlfs._perf_counter_ns()
+    await target.close(fh)
+    seconds += (sqlfs._perf_counter_ns() - t0) / 1e9
+    await target.unlink(name)
+    return summary(latencies, seconds, count * io_size)
+
+
+async def create_delete(target, nfiles):
+    data = os.urandom(4096)
+    names = [b'small%d' % i for i in range(nfiles)]
+
+    async def create(name):
+        fh = await target.create(name)
+        await target.write(fh, 0, data)
+        await target.close(fh)
+
+    latencies, seconds = await timed([(create, (name,)) for name in names])
+    unlinks, unlink_seconds = await timed([(target.unlink, (name,)) for name in names])
+    return summary(latencies + unlinks, seconds + unlink_seconds)
+
+
+async def stat_storm(target, nfiles, rounds=10):
+    names = [b'stat%d' % i for i in range(nfiles)]
+    for name in names:
+        await target.close(await target.create(name))
+    latencies, seconds = await timed([(target.stat, (name,)) for _ in range(rounds) for name in names])
+    for name in names:
+        await target.unlink(name)
+    return summary(latencies, seconds)
+
+
+async def listdir(target, nentries):
+    names = [b'entry%d' % i for i in range(nentries)]
+    for name in names:
+        await target.close(await target.create(name))
+    start = sqlfs._perf_counter_ns()
+    count = await target.listdir()
+    seconds = (sqlfs._perf_counter_ns() - start) / 1e9
+    for name in names:
+        await target.unlink(name)
+    return {'entries': count, 'seconds': seconds, 'entries_per_s': count / seconds if seconds else None}
+
+
+async def run_workloads(target, args):
+    results = []
+    for workload in args.workloads:
+        if workload in ('seq_write', 'seq_read', 'rand_write', 'rand_read'):
+            for io_size in args.io_sizes:
+                result = await io_workload(target, workload, io_size, args.file_size)
+                results.append(dict(workload=workload, io_size=io_size, **result))
+        elif workload == 'create_delete':
+            results.append(dict(workload=workload, **await create_delete(target, args.files)))
+        elif workload == 'stat':
+            results.append(dict(workload=workload, **await stat_storm(target, args.files)))
+        elif workload == 'listdir':
+            results.append(dict(workload=workload, **await listdir(target, args.entries)))
+    return results
+
+
+def run_variant(backend, variant, args):
+    if variant == 'encrypted' and backend == 'ops' and not sqlcipher_loaded():
+        return [{'skipped': 'sqlcipher is not loaded, run with LD_PRELOAD=libsqlcipher.so.0'}]
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = ':memory:' if variant == 'memory' else os.path.join(tmp, 'fs.db')
+        key = 'benchmark' if variant == 'encrypted' else None
+        if backend == 'ops':
+            _, options = args.script.parse_options(args.options)
+            target = OpsTarget(db_path, key, args.script.operations_options(options))
+        else:
+            target = FuseTarget(db_path, key, args.options, tmp)
+        try:
+            return trio.run(run_workloads, target, args)
+        finally:
+            target.close_target()
+
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, stdout=subprocess.PIPE, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.decode().strip()
+
+
+def compare(results, baseline):
+    # throughput of every result relative to the same one in the baseline
+    def key(result):
+        return (result['backend'], result['variant'], result.get('workload'), result.get('io_size'))
+
+    old = {key(result): result for result in baseline['results']}
+    for result in results['results']:
+        before = old.get(key(result))
+        for metric in ('mb_per_s', 'ops_per_s', 'entries_per_s'):
+            if before and result.get(metric) and before.get(metric):
+                ratio = result[metric] / before[metric]
+                print(f'{" ".join(str(k) for k in key(result) if k is not None)}: {metric} {ratio:.2f}x', file=sys.stderr)
+                break
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark sqlfs')
+    parser.add_argument('-b', '--backend', action='append', choices=('ops', 'fuse'),
+                        help='Call sqlfs.Operations directly (ops, default) or mount it (fuse)')
+    parser.add_argument('-v', '--variant', action='append', choices=VARIANTS, help='Database variants (default all)')
+    parser.add_argument('-w', '--workload', dest='workloads', action='append', choices=WORKLOADS,
+                        help='Workloads to run (default all)')
+    parser.add_argument('-s', '--io-size', dest='io_sizes', action='append', help='I/O sizes (default 4K, 64K and 1M)')
+    parser.add_argument('--file-size', default='64M', help='Size of the file used by I/O workloads')
+    parser.add_argument('--files', type=int, default=1000, help='Files used by the create and stat workloads')
+    parser.add_argument('--entries', type=int, default=10000, help='Directory size for the listdir workload')
+    parser.add_argument('-o', '--options', action='append', default=[], metavar='opt', help='sqlfs mount options')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args(argv[1:])
+    args.script = load_script()
+    args.backend = args.backend or ['ops']
+    args.variant = args.variant or list(VARIANTS)
+    args.workloads = args.workloads or list(WORKLOADS)
+    args.io_sizes = [args.script.parse_size(v) for v in args.io_sizes or ['4K', '64K', '1M']]
+    args.file_size = args.script.parse_size(args.file_size)
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    results = []
+    for backend in args.backend:
+        for variant in args.variant:
+            print(f'{backend} {variant}', file=sys.stderr)
+            try:
+                variant_results = run_variant(backend, variant, args)
+            except (OSError, RuntimeError, sqlite3.Error) as e:
+                variant_results = [{'error': str(e)}]
+            for result in variant_results:
+                results.append(dict(backend=backend, variant=variant, **result))
+    output = {
+        'commit': git_commit(),
+        'time': time.time(),
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'options': args.options,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(output, fd, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(output, json.load(fd))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -8,5 +8,8 @@ setup(
     scripts=['sqlfs'],
     install_requires=[
         'pyfuse3',
-    ]
+    ],
+    extras_require={
+        'zstd': ['zstandard'],
+    }
 )
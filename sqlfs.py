@@ -1,10 +1,29 @@
 import os
+import json
+import lzma
+import zlib
 import stat
 import time
 import errno
+import queue
 import sqlite3
+import threading
+import functools
+import itertools
+import contextlib
+import collections
+import concurrent.futures
+import bisect
 import hashlib
+import cProfile
+import pstats
 import pyfuse3
+import trio
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 if hasattr(time, 'time_ns'):
@@ -13,24 +32,142 @@ else:
     def _timestamp_ns():
         return int(time.time() * 1e9)
 
+if hasattr(time, 'perf_counter_ns'):
+    _perf_counter_ns = time.perf_counter_ns
+else:
+    def _perf_counter_ns():
+        return int(time.perf_counter() * 1e9)
+
+
+Codec = collections.namedtuple('Codec', ('id', 'name', 'compress', 'decompress'))
+
+# block compression codecs, the id is stored with each block so a database
+# can hold blocks written with different codecs
+CODECS = [
+    Codec(1, 'zlib', zlib.compress, zlib.decompress),
+    Codec(2, 'lzma', lzma.compress, lzma.decompress),
+]
+if zstandard is not None:
+    CODECS.append(Codec(3, 'zstd', zstandard.compress, zstandard.decompress))
+
+
+# fallocate modes, from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+
+
+# the virtual control directory, /.sqlfs, and its files use inode numbers
+# above any sqlite rowid so they never clash with real inodes
+CONTROL_NAME = b'.sqlfs'
+CONTROL_INODE = (1 << 63) + 1
+STATS_NAME = b'stats'
+STATS_INODE = (1 << 63) + 2
+VIRTUAL_INODES = frozenset((CONTROL_INODE, STATS_INODE))
+
 
 class Database:
 
-    def __init__(self, db_path, key=None):
-        self.conn = sqlite3.connect(db_path)
-        self.conn.row_factory = sqlite3.Row
-        self.init_tables(key)
+    # schema version, stored in the database as PRAGMA user_version
+    version = 5
 
-    def init_tables(self, key=None):
+    synchronous_modes = ('off', 'normal', 'full', 'extra')
+
+    temp_store_modes = ('default', 'file', 'memory')
+
+    # statements each connection keeps prepared, keyed by their text
+    cached_statements = 256
+
+    def __init__(self, db_path, key=None, wal=False, synchronous=None, wal_autocheckpoint=None, readers=0,
+                 block_size=4096, compression=None, dedup=False, restore=None, page_size=None, page_cache=None,
+                 mmap_size=None, temp_store=None, cipher_page_size=None, kdf_iter=None):
         if key is not None:
             # hash it for sqli prevention
             key = hashlib.md5(bytes(key, 'utf8')).hexdigest()
-            self.conn.execute(f'PRAGMA key=\'{key}\'')
+        if restore and not hasattr(sqlite3.Connection, 'backup'):
+            raise ValueError('restore requires Python 3.7 or later')
+        self.db_path = db_path
+        self.key = key
+        self.init_pragmas(page_size, page_cache, mmap_size, temp_store, cipher_page_size, kdf_iter)
+        self.local = threading.local()
+        self.commits = 0
+        self.commit_ns = 0
+        self.conn = self.connect()
+        if restore:
+            self.restore(restore)
+        self.init_tables()
+        self.init_config(block_size=block_size)
+        self.init_codecs(compression)
+        self.dedup = dedup
+        self.init_journal(wal, synchronous, wal_autocheckpoint)
+
+        # inodes left behind by an unclean unmount
+        self.cleanup_inodes()
+        self.commit()
+
+        # read only connections, these can only run alongside the writer in
+        # wal mode
+        self.readers = None
+        self.nreaders = readers if self.wal else 0
+        if self.nreaders:
+            self.readers = queue.Queue()
+            for _ in range(self.nreaders):
+                conn = self.connect()
+                conn.execute('PRAGMA query_only=ON')
+                self.readers.put(conn)
+
+    def connect(self, db_path=None):
+        conn = sqlite3.connect(db_path or self.db_path, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row
+        if self.key is not None:
+            conn.execute(f'PRAGMA key=\'{self.key}\'')
+            # these have to come before the database is first read
+            for name, value in self.cipher_pragmas.items():
+                conn.execute(f'PRAGMA {name}={value}')
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name}={value}')
+        return conn
+
+    def init_pragmas(self, page_size=None, page_cache=None, mmap_size=None, temp_store=None, cipher_page_size=None,
+                     kdf_iter=None):
+        # applied to every connection, including readers and snapshots
+        self.cipher_pragmas = {}
+        if cipher_page_size is not None:
+            self.cipher_pragmas['cipher_page_size'] = int(cipher_page_size)
+        if kdf_iter is not None:
+            self.cipher_pragmas['kdf_iter'] = int(kdf_iter)
+        self.pragmas = {}
+        # only takes effect when the database is created or vacuumed
+        if page_size is not None:
+            self.pragmas['page_size'] = int(page_size)
+        # a negative cache_size is in KiB rather than pages
+        if page_cache is not None:
+            self.pragmas['cache_size'] = -(int(page_cache) >> 10)
+        if temp_store is not None:
+            if temp_store.lower() not in self.temp_store_modes:
+                raise ValueError(f'invalid temp_store mode: {temp_store}')
+            self.pragmas['temp_store'] = temp_store
+        # sqlcipher can't map encrypted pages, and memory databases have no
+        # file to map
+        if mmap_size is not None and self.key is None and self.db_path != ':memory:':
+            self.pragmas['mmap_size'] = int(mmap_size)
+
+    def init_tables(self):
+        # upgrade tables created by older versions
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        if not self.migrate():
+            # free pages are given back by incremental_vacuum rather than a
+            # full VACUUM, this can only be set before any tables exist
+            self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
 
         # create tables
         self.conn.executescript(
             '''
-            PRAGMA foreign_keys=ON;
+            CREATE TABLE IF NOT EXISTS config (
+                name TEXT PRIMARY KEY,
+                value NOT NULL
+            );
             CREATE TABLE IF NOT EXISTS inode (
                 id INTEGER PRIMARY KEY,
                 uid INTEGER NOT NULL,
@@ -41,7 +178,11 @@ class Database:
                 ctime_ns INTEGER NOT NULL,
                 target BLOB DEFAULT NULL,
                 size INTEGER NOT NULL DEFAULT 0,
-                rdev INTEGER NOT NULL DEFAULT 0
+                rdev INTEGER NOT NULL DEFAULT 0,
+                nlink INTEGER NOT NULL DEFAULT 0,
+                nchild INTEGER NOT NULL DEFAULT 0,
+                nblock INTEGER NOT NULL DEFAULT 0,
+                nxattr INTEGER NOT NULL DEFAULT 0
             );
             CREATE TABLE IF NOT EXISTS link (
                 id INTEGER PRIMARY KEY,
@@ -52,15 +193,93 @@ class Database:
                 name BLOB NOT NULL,
                 UNIQUE (parent_inode, name)
             );
+            CREATE INDEX IF NOT EXISTS link_parent ON link(parent_inode, id, inode, name);
+            -- deleting an inode cascades to its links
+            CREATE INDEX IF NOT EXISTS link_inode ON link(inode);
+            CREATE INDEX IF NOT EXISTS inode_orphan ON inode(id) WHERE nlink=0;
             CREATE TABLE IF NOT EXISTS block (
                 inode INTEGER NOT NULL
                     REFERENCES inode(id) ON DELETE CASCADE,
                 idx INTEGER NOT NULL,
                 data BLOB NOT NULL,
+                codec INTEGER NOT NULL DEFAULT 0,
+                chunk INTEGER DEFAULT NULL,
                 PRIMARY KEY (inode, idx)
             ) WITHOUT ROWID;
+            -- deduplicated block data, shared by every block with the same
+            -- content and deleted along with the last block using it
+            CREATE TABLE IF NOT EXISTS chunk (
+                id INTEGER PRIMARY KEY,
+                hash BLOB NOT NULL UNIQUE,
+                refs INTEGER NOT NULL DEFAULT 0,
+                codec INTEGER NOT NULL DEFAULT 0,
+                data BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS xattr (
+                inode INTEGER NOT NULL
+                    REFERENCES inode(id) ON DELETE CASCADE,
+                name BLOB NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (inode, name)
+            ) WITHOUT ROWID;
+
+            -- keep the inode link, child, block and xattr counts up to date
+            CREATE TRIGGER IF NOT EXISTS link_insert AFTER INSERT ON link
+            BEGIN
+                UPDATE inode SET nlink=nlink+1 WHERE id=new.inode;
+                UPDATE inode SET nchild=nchild+1 WHERE id=new.parent_inode;
+            END;
+            CREATE TRIGGER IF NOT EXISTS link_delete AFTER DELETE ON link
+            BEGIN
+                UPDATE inode SET nlink=nlink-1 WHERE id=old.inode;
+                UPDATE inode SET nchild=nchild-1 WHERE id=old.parent_inode;
+            END;
+            CREATE TRIGGER IF NOT EXISTS link_update AFTER UPDATE OF inode, parent_inode ON link
+            BEGIN
+                UPDATE inode SET nlink=nlink-1 WHERE id=old.inode;
+                UPDATE inode SET nchild=nchild-1 WHERE id=old.parent_inode;
+                UPDATE inode SET nlink=nlink+1 WHERE id=new.inode;
+                UPDATE inode SET nchild=nchild+1 WHERE id=new.parent_inode;
+            END;
+            CREATE TRIGGER IF NOT EXISTS block_insert AFTER INSERT ON block
+            BEGIN
+                UPDATE inode SET nblock=nblock+1 WHERE id=new.inode;
+            END;
+            CREATE TRIGGER IF NOT EXISTS block_delete AFTER DELETE ON block
+            BEGIN
+                UPDATE inode SET nblock=nblock-1 WHERE id=old.inode;
+            END;
+            CREATE TRIGGER IF NOT EXISTS xattr_insert AFTER INSERT ON xattr
+            BEGIN
+                UPDATE inode SET nxattr=nxattr+1 WHERE id=new.inode;
+            END;
+            CREATE TRIGGER IF NOT EXISTS xattr_delete AFTER DELETE ON xattr
+            BEGIN
+                UPDATE inode SET nxattr=nxattr-1 WHERE id=old.inode;
+            END;
+
+            -- keep the chunk reference counts up to date
+            CREATE TRIGGER IF NOT EXISTS chunk_insert AFTER INSERT ON block
+            WHEN new.chunk IS NOT NULL
+            BEGIN
+                UPDATE chunk SET refs=refs+1 WHERE id=new.chunk;
+            END;
+            CREATE TRIGGER IF NOT EXISTS chunk_delete AFTER DELETE ON block
+            WHEN old.chunk IS NOT NULL
+            BEGIN
+                UPDATE chunk SET refs=refs-1 WHERE id=old.chunk;
+                DELETE FROM chunk WHERE id=old.chunk AND refs=0;
+            END;
+            CREATE TRIGGER IF NOT EXISTS chunk_update AFTER UPDATE OF chunk ON block
+            WHEN old.chunk IS NOT new.chunk
+            BEGIN
+                UPDATE chunk SET refs=refs+1 WHERE id=new.chunk;
+                UPDATE chunk SET refs=refs-1 WHERE id=old.chunk;
+                DELETE FROM chunk WHERE id=old.chunk AND refs=0;
+            END;
             '''
         )
+        self.conn.execute(f'PRAGMA user_version={self.version}')
 
         # create root inode
         now_ns = _timestamp_ns()
@@ -89,14 +308,140 @@ class Database:
                 (1, 1, b'..'),
             ]
         )
+        self.conn.commit()
+
+    def init_config(self, block_size=4096):
+        if block_size < 512 or block_size & (block_size - 1):
+            raise ValueError(f'invalid block size: {block_size}')
+        # settings are fixed once there is data, older databases always used
+        # 4096 byte blocks
+        data = self.conn.execute('SELECT EXISTS (SELECT * FROM block)').fetchone()[0]
+        self.conn.execute(
+            '''
+            INSERT OR IGNORE INTO config (
+                name, value
+            ) VALUES (?, ?)
+            ''',
+            ('block_size', 4096 if data else block_size)
+        )
+        self.conn.commit()
+        self.blksize = self.get_config('block_size')
+
+    def get_config(self, name):
+        row = self.conn.execute(
+            '''
+            SELECT value
+            FROM config
+            WHERE name=?
+            ''',
+            (name,)
+        ).fetchone()
+        return row['value'] if row else None
+
+    def init_codecs(self, compression=None):
+        self.codecs = {codec.id: codec for codec in CODECS}
+        # make sure every codec blocks have been written with is available
+        for row in self.conn.execute("SELECT name, value FROM config WHERE name LIKE 'codec_%'"):
+            if int(row['name'][6:]) not in self.codecs:
+                raise ValueError(f'database uses unavailable compression: {row["value"]}')
+        self.codec = None
+        if compression is not None:
+            for codec in CODECS:
+                if codec.name == compression:
+                    self.codec = codec
+                    break
+            else:
+                raise ValueError(f'unsupported compression: {compression}')
+            self.conn.execute(
+                '''
+                INSERT OR IGNORE INTO config (
+                    name, value
+                ) VALUES (?, ?)
+                ''',
+                (f'codec_{self.codec.id}', self.codec.name)
+            )
+            self.conn.commit()
+
+    def init_journal(self, wal=False, synchronous=None, wal_autocheckpoint=None):
+        self.wal = False
+        if wal and self.db_path != ':memory:':
+            mode = self.conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            self.wal = mode.lower() == 'wal'
+        if synchronous is not None:
+            if synchronous.lower() not in self.synchronous_modes:
+                raise ValueError(f'invalid synchronous mode: {synchronous}')
+            self.conn.execute(f'PRAGMA synchronous={synchronous}')
+        if wal_autocheckpoint is not None:
+            self.conn.execute(f'PRAGMA wal_autocheckpoint={int(wal_autocheckpoint)}')
+
+    @property
+    def reader(self):
+        # the read connection in use by this thread, if any
+        return getattr(self.local, 'conn', None) or self.conn
+
+    @contextlib.contextmanager
+    def reading(self):
+        if self.readers is None or getattr(self.local, 'conn', None):
+            yield
+            return
+        self.local.conn = self.readers.get()
+        try:
+            yield
+        finally:
+            self.readers.put(self.local.conn)
+            self.local.conn = None
+
+    def migrate(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        tables = self.conn.execute(
+            '''
+            SELECT COUNT(*)
+            FROM sqlite_master
+            WHERE type='table' AND name='inode'
+            '''
+        ).fetchone()[0]
+        if not tables:
+            return False
+
+        # materialized counts
+        if version < 1:
+            for col in ('nlink', 'nchild', 'nblock'):
+                self.conn.execute(f'ALTER TABLE inode ADD COLUMN {col} INTEGER NOT NULL DEFAULT 0')
+            self.conn.execute(
+                '''
+                UPDATE inode SET
+                    nlink=(SELECT COUNT(*) FROM link WHERE inode=inode.id),
+                    nchild=(SELECT COUNT(*) FROM link WHERE parent_inode=inode.id),
+                    nblock=(SELECT COUNT(*) FROM block WHERE inode=inode.id)
+                '''
+            )
+            self.conn.commit()
+
+        # block compression
+        if version < 2:
+            self.conn.execute('ALTER TABLE block ADD COLUMN codec INTEGER NOT NULL DEFAULT 0')
+
+        # block deduplication
+        if version < 3:
+            self.conn.execute('ALTER TABLE block ADD COLUMN chunk INTEGER DEFAULT NULL')
+
+        # all zero blocks are holes rather than empty rows
+        if version < 4:
+            self.conn.execute("DELETE FROM block WHERE chunk IS NULL AND data=X''")
+            # the block_delete trigger doesn't exist yet when upgrading from
+            # version 0, so the counts from above still include these
+            self.conn.execute('UPDATE inode SET nblock=(SELECT COUNT(*) FROM block WHERE inode=inode.id)')
+            self.conn.commit()
+
+        # extended attributes, there were none before
+        if version < 5:
+            self.conn.execute('ALTER TABLE inode ADD COLUMN nxattr INTEGER NOT NULL DEFAULT 0')
+        return True
 
     def get_inode_from_id(self, inode):
-        return self.conn.execute(
+        return self.reader.execute(
             '''
-            SELECT *,
-                (SELECT COUNT(*) FROM link WHERE inode=inode.id) AS nlink,
-                (SELECT COUNT(*) FROM link WHERE parent_inode=inode.id) AS nchild,
-                (SELECT COUNT(*) FROM block WHERE inode=inode.id) AS nblock
+            SELECT *
             FROM inode
             WHERE id=?
             ''',
@@ -104,12 +449,9 @@ class Database:
         ).fetchone()
 
     def get_inode_from_parent_and_name(self, parent_inode, name):
-        return self.conn.execute(
+        return self.reader.execute(
             '''
             SELECT inode.*,
-                (SELECT COUNT(*) FROM link WHERE inode=inode.id) AS nlink,
-                (SELECT COUNT(*) FROM link WHERE parent_inode=inode.id) AS nchild,
-                (SELECT COUNT(*) FROM block WHERE inode=inode.id) AS nblock,
                 link.id AS link_id
             FROM inode
             INNER JOIN link ON inode.id=inode
@@ -118,44 +460,100 @@ class Database:
             (parent_inode, name)
         ).fetchone()
 
-    def get_inodes_from_parent(self, parent_inode, start_id=None):
-        where = ['parent_inode=?']
-        params = [parent_inode]
-        if start_id is not None:
-            where.append('link.id>?')
-            params.append(start_id)
-        where = ' AND '.join(where)
-        return self.conn.execute(
-            f'''
+    def get_inodes_from_parent(self, parent_inode, start_id=0):
+        # walks link_parent in order, so resuming a listing neither sorts
+        # nor rescans the entries already returned
+        return self.reader.execute(
+            '''
             SELECT inode.*,
-                (SELECT COUNT(*) FROM link WHERE inode=inode.id) AS nlink,
-                (SELECT COUNT(*) FROM link WHERE parent_inode=inode.id) AS nchild,
-                (SELECT COUNT(*) FROM block WHERE inode=inode.id) AS nblock,
                 link.id AS link_id,
                 name
-            FROM inode
-            INNER JOIN link ON inode.id=inode
-            WHERE {where}
+            FROM link INDEXED BY link_parent
+            INNER JOIN inode ON inode.id=link.inode
+            WHERE parent_inode=? AND link.id>?
             ORDER BY link.id
             ''',
-            params
+            (parent_inode, start_id)
         )
 
+    def _tuples(self, conn):
+        # rows that are unpacked straight away don't need sqlite3.Row
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        return cursor
+
     def get_blocks(self, inode, first_idx, last_idx):
-        return self.conn.execute(
+        rows = self._tuples(self.reader).execute(
             '''
-            SELECT *
+            SELECT idx, IFNULL(chunk.codec, block.codec), IFNULL(chunk.data, block.data)
             FROM block
+            LEFT JOIN chunk ON chunk.id=block.chunk
             WHERE inode=? AND idx>=? AND idx<=?
             ''',
             (inode, first_idx, last_idx)
         )
+        for idx, codec, data in rows:
+            if codec:
+                data = self.codecs[codec].decompress(data)
+            yield idx, data
+
+    def get_next_data(self, inode, idx):
+        return self._tuples(self.reader).execute(
+            '''
+            SELECT MIN(idx)
+            FROM block
+            WHERE inode=? AND idx>=?
+            ''',
+            (inode, idx)
+        ).fetchone()[0]
+
+    def get_next_hole(self, inode, idx):
+        return self._tuples(self.reader).execute(
+            '''
+            SELECT CASE
+                WHEN NOT EXISTS (SELECT * FROM block WHERE inode=?1 AND idx=?2) THEN ?2
+                ELSE (
+                    SELECT a.idx + 1
+                    FROM block a
+                    WHERE a.inode=?1 AND a.idx>=?2 AND NOT EXISTS (
+                        SELECT *
+                        FROM block b
+                        WHERE b.inode=?1 AND b.idx=a.idx + 1
+                    )
+                    ORDER BY a.idx
+                    LIMIT 1
+                )
+            END
+            ''',
+            (inode, idx)
+        ).fetchone()[0]
+
+    def get_xattr(self, inode, name):
+        row = self.reader.execute(
+            '''
+            SELECT value
+            FROM xattr
+            WHERE inode=? AND name=?
+            ''',
+            (inode, name)
+        ).fetchone()
+        return row and row['value']
+
+    def get_xattrs(self, inode):
+        return [row['name'] for row in self.reader.execute(
+            '''
+            SELECT name
+            FROM xattr
+            WHERE inode=?
+            ''',
+            (inode,)
+        )]
 
     def get_stats(self):
-        return self.conn.execute(
+        return self.reader.execute(
             '''
             SELECT
-                (SELECT COUNT(*) FROM block) AS f_blocks,
+                (SELECT IFNULL(SUM(nblock), 0) FROM inode) AS f_blocks,
                 (SELECT COUNT(*) FROM inode) AS f_files
             '''
         ).fetchone()
@@ -177,70 +575,175 @@ class Database:
         )
         return inode
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _insert_sql(table, cols):
+        # built once per combination of columns, the text is then always the
+        # same and the prepared statement is reused
+        return f'''
+            INSERT INTO {table} (
+                {','.join(cols)}
+            ) VALUES ({','.join('?' * len(cols))})
+            '''
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _update_sql(table, cols):
+        return f'''
+            UPDATE {table}
+            SET {','.join(f'{col}=?' for col in cols)}
+            WHERE id=?
+            '''
+
     def create_inode(self, parent_inode, name, uid, gid, mode, **kwargs):
         now_ns = _timestamp_ns()
-        cols = ['uid', 'gid', 'mode', 'mtime_ns', 'atime_ns', 'ctime_ns']
-        vals = ['?', '?', '?', '?', '?', '?']
-        params = [uid, gid, mode, now_ns, now_ns, now_ns]
-        for col, param in kwargs.items():
-            cols.append(col)
-            vals.append('?')
-            params.append(param)
-        cols = ','.join(cols)
-        vals = ','.join(vals)
-        inode = self.conn.execute(
-            f'''
-            INSERT INTO inode (
-                {cols}
-            ) VALUES ({vals})
-            ''',
-            params
-        ).lastrowid
+        attrs = {'uid': uid, 'gid': gid, 'mode': mode, 'mtime_ns': now_ns, 'atime_ns': now_ns, 'ctime_ns': now_ns}
+        attrs.update(kwargs)
+        inode = self.conn.execute(self._insert_sql('inode', tuple(attrs)), tuple(attrs.values())).lastrowid
         return self.create_link(inode, parent_inode, name, stat.S_ISDIR(mode))
 
-    def _update_stmts(self, **kwargs):
-        stmts, params = [], []
-        for col, param in kwargs.items():
-            stmts.append(f'{col}=?')
-            params.append(param)
-        return stmts, params
-
     def update_inode(self, inode, **kwargs):
         if kwargs:
-            stmts, params = self._update_stmts(**kwargs)
-            params.append(inode)
-            stmt = ','.join(stmts)
-            self.conn.execute(
-                f'''
-                UPDATE inode
-                SET {stmt}
-                WHERE id=?
-                ''',
-                params
-            )
+            self.conn.execute(self._update_sql('inode', tuple(kwargs)), (*kwargs.values(), inode))
+
+    def update_inodes(self, inodes):
+        # inodes updating the same columns share one executemany
+        groups = {}
+        for inode, kwargs in inodes:
+            if kwargs:
+                groups.setdefault(tuple(kwargs), []).append((*kwargs.values(), inode))
+        for cols, params in groups.items():
+            self.conn.executemany(self._update_sql('inode', cols), params)
 
     def update_link(self, link, **kwargs):
         if kwargs:
-            stmts, params = self._update_stmts(**kwargs)
-            params.append(link)
-            stmt = ','.join(stmts)
-            self.conn.execute(
-                f'''
-                UPDATE link
-                SET {stmt}
-                WHERE id=?
-                ''',
-                params
-            )
+            self.conn.execute(self._update_sql('link', tuple(kwargs)), (*kwargs.values(), link))
+
+    def update_link_parent(self, inode, parent_inode):
+        # the '..' entry of a directory that moved to another parent
+        self.conn.execute(
+            '''
+            UPDATE link
+            SET inode=?
+            WHERE parent_inode=? AND name=X'2E2E'
+            ''',
+            (parent_inode, inode)
+        )
+
+    def _pack(self, data):
+        # only keep compressed data that is actually smaller
+        if self.codec and data:
+            packed = self.codec.compress(data)
+            if len(packed) < len(data):
+                return packed, self.codec.id
+        return data, 0
+
+    def _chunk(self, data):
+        digest = hashlib.sha256(data).digest()
+        row = self._tuples(self.conn).execute(
+            '''
+            SELECT id
+            FROM chunk
+            WHERE hash=?
+            ''',
+            (digest,)
+        ).fetchone()
+        if row:
+            return row[0]
+        data, codec = self._pack(data)
+        return self.conn.execute(
+            '''
+            INSERT INTO chunk (
+                hash, codec, data
+            ) VALUES (?, ?, ?)
+            ''',
+            (digest, codec, data)
+        ).lastrowid
+
+    def _encode(self, blocks):
+        for inode, idx, data in blocks:
+            chunk = None
+            if self.dedup and data:
+                chunk = self._chunk(data)
+                data, codec = b'', 0
+            else:
+                data, codec = self._pack(data)
+            yield inode, idx, data, codec, chunk
 
     def update_blocks(self, blocks):
-        self.conn.executemany(
+        # empty blocks are holes so are deleted rather than stored
+        holes = []
+
+        def data_blocks():
+            for block in blocks:
+                if block[2]:
+                    yield block
+                else:
+                    holes.append(block[:2])
+
+        self._update_blocks(data_blocks())
+        if holes:
+            self.delete_blocks(holes)
+
+    def _update_blocks(self, blocks):
+        stmt = '''
+            INSERT INTO block (
+                inode, idx, data, codec, chunk
+            ) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (inode, idx) DO UPDATE SET
+                data=excluded.data, codec=excluded.codec, chunk=excluded.chunk
             '''
-            INSERT OR REPLACE INTO block (
-                inode, idx, data
+        if not self.dedup:
+            self.conn.executemany(stmt, self._encode(blocks))
+            return
+        # chunks are looked up as each block is written, a block earlier in
+        # the batch may release a chunk that a later one would have reused
+        for block in self._encode(blocks):
+            self.conn.execute(stmt, block)
+
+    def copy_blocks(self, inode, first_idx, dst_inode, dst_first_idx, count):
+        # holes in the source range are holes in the copy too, with dedup the
+        # copy shares the source's chunks until either side is rewritten
+        self.delete_block_range(dst_inode, dst_first_idx, dst_first_idx + count)
+        self.conn.execute(
+            '''
+            INSERT INTO block (
+                inode, idx, data, codec, chunk
+            ) SELECT ?, idx+?, data, codec, chunk
+            FROM block
+            WHERE inode=? AND idx>=? AND idx<?
+            ''',
+            (dst_inode, dst_first_idx - first_idx, inode, first_idx, first_idx + count)
+        )
+
+    def update_xattr(self, inode, name, value):
+        self.conn.execute(
+            '''
+            INSERT INTO xattr (
+                inode, name, value
             ) VALUES (?, ?, ?)
+            ON CONFLICT (inode, name) DO UPDATE SET
+                value=excluded.value
             ''',
-            blocks
+            (inode, name, value)
+        )
+
+    def delete_xattr(self, inode, name):
+        return self.conn.execute(
+            '''
+            DELETE FROM xattr
+            WHERE inode=? AND name=?
+            ''',
+            (inode, name)
+        ).rowcount
+
+    def delete_block_range(self, inode, first_idx, end_idx):
+        self.conn.execute(
+            '''
+            DELETE FROM block
+            WHERE inode=? AND idx>=? AND idx<?
+            ''',
+            (inode, first_idx, end_idx)
         )
 
     def delete_link(self, link):
@@ -275,6 +778,15 @@ class Database:
             (inode,)
         )
 
+    def delete_blocks(self, blocks):
+        self.conn.executemany(
+            '''
+            DELETE FROM block
+            WHERE inode=? AND idx=?
+            ''',
+            blocks
+        )
+
     def truncate_blocks(self, inode, idx):
         self.conn.execute(
             '''
@@ -288,49 +800,434 @@ class Database:
         self.conn.execute(
             '''
             DELETE FROM inode
-            WHERE inode.id IN (
-                SELECT a.id
-                FROM (
-                    SELECT inode.id, link.inode FROM inode
-                    LEFT JOIN link ON link.inode=inode.id
-                ) a
-                INNER JOIN
-                (
-                    SELECT inode.id, link.inode FROM inode
-                    LEFT JOIN link ON link.parent_inode=inode.id
-                ) b
-                ON a.id=b.id
-                WHERE a.inode IS NULL AND b.inode IS NULL
-            )
+            WHERE nlink=0 AND nchild=0
             '''
         )
 
     def vacuum(self):
+        # also converts databases created without incremental auto vacuum
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
         self.conn.execute('VACUUM')
 
+    def incremental_vacuum(self, pages):
+        freelist = self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if freelist:
+            # executescript steps the pragma to completion (one page per step)
+            self.conn.commit()
+            self.conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        return min(freelist, pages)
+
+    def backup(self, path, pages=-1, progress=None):
+        # copied to a temporary file first so that path is always complete
+        self.commit()
+        tmp_path = f'{path}.tmp'
+        target = self.connect(tmp_path)
+        try:
+            self.conn.backup(target, pages=pages, progress=progress)
+        finally:
+            target.close()
+        os.replace(tmp_path, path)
+
+    def restore(self, path):
+        source = self.connect(path)
+        try:
+            source.backup(self.conn)
+        finally:
+            source.close()
+
     def commit(self):
+        start = _perf_counter_ns()
         self.conn.commit()
+        self.commits += 1
+        self.commit_ns += _perf_counter_ns() - start
 
     def rollback(self):
         self.conn.rollback()
 
-    def close(self):
+    def close(self, vacuum=False):
         self.cleanup_inodes()
         self.commit()
-        self.vacuum()
+        if vacuum:
+            self.vacuum()
+        for _ in range(self.nreaders):
+            self.readers.get().close()
         self.conn.close()
 
 
+class WriteBackCache:
+
+    def __init__(self, db, max_bytes, max_age):
+        self.db = db
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.blocks = {}
+        self.inodes = {}
+        self.nbytes = 0
+        self.dirtied = None
+
+    def __contains__(self, inode):
+        return inode in self.blocks or inode in self.inodes
+
+    @property
+    def expired(self):
+        if self.dirtied is None:
+            return False
+        if self.nbytes >= self.max_bytes:
+            return True
+        return time.monotonic() - self.dirtied >= self.max_age
+
+    def _dirty(self):
+        if self.dirtied is None:
+            self.dirtied = time.monotonic()
+
+    def get_block(self, inode, idx):
+        return self.blocks.get(inode, {}).get(idx)
+
+    def get_blocks(self, inode, first_idx, last_idx):
+        blocks = self.blocks.get(inode)
+        if blocks:
+            for idx in range(first_idx, last_idx + 1):
+                data = blocks.get(idx)
+                if data is not None:
+                    yield idx, data
+
+    def get_inode(self, inode):
+        return self.inodes.get(inode, {})
+
+    def update_block(self, inode, idx, data):
+        blocks = self.blocks.setdefault(inode, {})
+        old = blocks.get(idx)
+        if old is not None:
+            self.nbytes -= len(old)
+        blocks[idx] = data
+        self.nbytes += len(data)
+        self._dirty()
+
+    def update_inode(self, inode, **kwargs):
+        self.inodes.setdefault(inode, {}).update(kwargs)
+        self._dirty()
+
+    def truncate_blocks(self, inode, idx):
+        blocks = self.blocks.get(inode, {})
+        for _idx in [i for i in blocks if i >= idx]:
+            self.nbytes -= len(blocks.pop(_idx))
+
+    def discard(self, inode):
+        for data in self.blocks.pop(inode, {}).values():
+            self.nbytes -= len(data)
+        self.inodes.pop(inode, None)
+
+    def _blocks(self):
+        for inode, blocks in self.blocks.items():
+            for idx, data in blocks.items():
+                yield inode, idx, data
+
+    def flush(self):
+        if self.dirtied is None:
+            return set()
+        self.db.update_blocks(self._blocks())
+        self.db.update_inodes(self.inodes.items())
+        self.db.commit()
+        flushed = set(self.blocks) | set(self.inodes)
+        self.blocks.clear()
+        self.inodes.clear()
+        self.nbytes = 0
+        self.dirtied = None
+        return flushed
+
+
+class BlockCache:
+
+    # approximate per entry bookkeeping cost, so cached holes count too
+    overhead = 128
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.blocks = collections.OrderedDict()
+        self.inodes = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        # bumped on every change so that blocks read from the database
+        # before the change are not cached after it
+        self.generation = 0
+
+    def _remove(self, inode, idx):
+        self.nbytes -= len(self.blocks.pop((inode, idx))) + self.overhead
+        idxs = self.inodes[inode]
+        idxs.discard(idx)
+        if not idxs:
+            del self.inodes[inode]
+
+    def _update(self, inode, idx, data):
+        if self.max_bytes <= 0:
+            return
+        key = (inode, idx)
+        if key in self.blocks:
+            self._remove(inode, idx)
+        self.blocks[key] = data
+        self.inodes.setdefault(inode, set()).add(idx)
+        self.nbytes += len(data) + self.overhead
+        while self.nbytes > self.max_bytes:
+            self._remove(*next(iter(self.blocks)))
+
+    def get_block(self, inode, idx):
+        key = (inode, idx)
+        with self.lock:
+            data = self.blocks.get(key)
+            if data is not None:
+                self.blocks.move_to_end(key)
+            return data
+
+    def fill_block(self, inode, idx, data, generation):
+        with self.lock:
+            if generation == self.generation:
+                self._update(inode, idx, data)
+
+    def update_block(self, inode, idx, data):
+        with self.lock:
+            self.generation += 1
+            self._update(inode, idx, data)
+
+    def truncate_blocks(self, inode, idx):
+        with self.lock:
+            self.generation += 1
+            idxs = self.inodes.get(inode, ())
+            for _idx in [i for i in idxs if i >= idx]:
+                self._remove(inode, _idx)
+
+    def discard(self, inode):
+        self.truncate_blocks(inode, 0)
+
+
+class AttrCache:
+
+    def __init__(self):
+        self.rows = {}
+        self.lock = threading.Lock()
+        # same scheme as the block cache, rows read before a change are
+        # not cached after it
+        self.generation = 0
+
+    def get(self, inode):
+        return self.rows.get(inode)
+
+    def fill(self, row, generation):
+        with self.lock:
+            if generation == self.generation:
+                self.rows[row['id']] = row
+
+    def discard(self, *inodes):
+        with self.lock:
+            self.generation += 1
+            for inode in inodes:
+                self.rows.pop(inode, None)
+
+
+class FileHandle:
+
+    def __init__(self, inode):
+        self.inode = inode
+        # offset the next read starts at when reading sequentially
+        self.next_off = 0
+        # bytes to read ahead of sequential reads, and the first block past
+        # those already read ahead
+        self.window = 0
+        self.ahead_idx = 0
+
+
+class Metrics:
+
+    # upper bounds of the latency histogram buckets, in microseconds
+    buckets = (10, 100, 1000, 10000, 100000, 1000000)
+
+    def __init__(self):
+        self.started = time.time()
+        self.ops = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+
+    def record(self, name, ns, result=None, error=False):
+        with self.lock:
+            op = self.ops.get(name)
+            if op is None:
+                op = self.ops[name] = {'count': 0, 'errors': 0, 'total_ns': 0, 'max_ns': 0,
+                                       'histogram': [0] * (len(self.buckets) + 1)}
+            op['count'] += 1
+            op['errors'] += error
+            op['total_ns'] += ns
+            op['max_ns'] = max(op['max_ns'], ns)
+            op['histogram'][bisect.bisect_left(self.buckets, ns // 1000)] += 1
+            if error:
+                return
+            if name == 'read':
+                self.bytes_read += len(result)
+            elif name == 'write':
+                self.bytes_written += result
+
+    def snapshot(self):
+        with self.lock:
+            ops = {}
+            for name, op in sorted(self.ops.items()):
+                ops[name] = dict(op, mean_us=op['total_ns'] / op['count'] / 1000)
+                ops[name]['histogram'] = dict(zip([f'<={b}us' for b in self.buckets] + ['more'], op['histogram']))
+            return {
+                'uptime': time.time() - self.started,
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'ops': ops,
+            }
+
+
+def _dbop(readonly=False, background=False):
+    # run an operation handler that uses the database, in threaded mode this
+    # happens in a worker thread so that the trio event loop is never blocked
+    def decorator(func):
+        def reading(self, *args):
+            with self.db.reading():
+                return func(self, *args)
+
+        handler = reading if readonly else func
+
+        async def call(self, args):
+            if not self.threaded:
+                run = functools.partial(self._profiled, func, self) if self.profile else functools.partial(func, self)
+                if not self.snapshotting:
+                    return run(*args)
+                # wait for the current snapshot step
+                async with self.write_limiter:
+                    return run(*args)
+            run = functools.partial(self._profiled, handler, self) if self.profile else functools.partial(handler, self)
+            limiter = self.read_limiter if readonly else self.write_limiter
+            return await trio.to_thread.run_sync(functools.partial(run, *args), limiter=limiter)
+
+        @functools.wraps(func)
+        async def wrapper(self, *args):
+            if not background:
+                self.active = time.monotonic()
+            start = _perf_counter_ns()
+            try:
+                result = await call(self, args)
+            except BaseException:
+                self.metrics.record(func.__name__, _perf_counter_ns() - start, error=True)
+                raise
+            self.metrics.record(func.__name__, _perf_counter_ns() - start, result)
+            return result
+        return wrapper
+    return decorator
+
+
 class Operations(pyfuse3.Operations):
 
-    blksize = 4096
-    blkmask = blksize - 1
-    blkshft = blkmask.bit_length()
+    # seconds without requests before background maintenance runs
+    idle_time = 5.0
+    # database pages copied per snapshot step, requests are served in between
+    snapshot_pages = 1024
+    # bytes copied at a time by copy_file_range when it can't copy blocks
+    copy_size = 1 << 20
 
-    def __init__(self, db_path, key=None):
+    def __init__(self, db_path, key=None, writeback_size=32 << 20, writeback_age=5.0, cache_size=64 << 20,
+                 threaded=False, vacuum=False, vacuum_pages=1024, attr_timeout=300.0, entry_timeout=300.0,
+                 writeback_cache=False, snapshot=None, stats=False, profile=None, readahead=4 << 20, **db_options):
         super().__init__()
+        # snapshots are taken with sqlite3's backup API
+        if snapshot and not hasattr(sqlite3.Connection, 'backup'):
+            raise ValueError('snapshot requires Python 3.7 or later')
         self.db_path = db_path
-        self.db = Database(self.db_path, key=key)
+        self.db = Database(self.db_path, key=key, **db_options)
+        self.blksize = self.db.blksize
+        self.blkmask = self.blksize - 1
+        self.blkshft = self.blkmask.bit_length()
+        self.threaded = threaded
+        self.vacuum = vacuum
+        self.vacuum_pages = vacuum_pages
+        self.active = time.monotonic()
+        self.snapshot_path = snapshot
+        self.snapshotting = False
+        # one writer, readers share it unless there are read connections
+        self.write_limiter = trio.CapacityLimiter(1)
+        self.read_limiter = self.write_limiter
+        if self.db.nreaders:
+            self.read_limiter = trio.CapacityLimiter(self.db.nreaders)
+        self.writeback = WriteBackCache(self.db, writeback_size, writeback_age)
+        self.cache = BlockCache(cache_size)
+        # open files, sequential reads on them are read ahead into the cache
+        self.handles = {}
+        self.fhs = itertools.count(1)
+        self.readahead = min(readahead, cache_size // 4)
+        # inode rows, kept until the kernel forgets the inode or it changes
+        self.attrs = AttrCache()
+        self.attr_timeout = attr_timeout
+        self.entry_timeout = entry_timeout
+        # let the kernel buffer writes, it then sends them in large batches
+        self.enable_writeback_cache = writeback_cache
+        # mtime and size of files when last opened, their page cache is kept
+        # if they haven't changed since
+        self.opened = {}
+        # kernel lookup counts, inodes are only deleted once these reach zero
+        self.lookups = {}
+        self.lookups_lock = threading.Lock()
+        self.metrics = Metrics()
+        # serve /.sqlfs/stats
+        self.stats = stats
+        self.stats_data = b''
+        # one profiler per thread that runs handlers, merged when dumped
+        self.profile = profile
+        self.profiles = []
+        self.profiles_local = threading.local()
+
+    def _profiled(self, func, *args):
+        profiler = getattr(self.profiles_local, 'profiler', None)
+        if profiler is None:
+            profiler = self.profiles_local.profiler = cProfile.Profile()
+            self.profiles.append(profiler)
+        return profiler.runcall(func, *args)
+
+    def dump_profile(self, path=None):
+        if self.profiles:
+            pstats.Stats(*self.profiles).dump_stats(path or self.profile)
+
+    def get_stats(self):
+        stats = self.metrics.snapshot()
+        stats.update({
+            'commits': self.db.commits,
+            'commit_ms': self.db.commit_ns / 1e6,
+            'rows_changed': self.db.conn.total_changes,
+            'writeback_bytes': self.writeback.nbytes,
+            'cache_bytes': self.cache.nbytes,
+            'cached_blocks': len(self.cache.blocks),
+            'cached_inodes': len(self.attrs.rows),
+            'lookups': len(self.lookups),
+        })
+        return stats
+
+    def _virtual_entry(self, inode):
+        entry = pyfuse3.EntryAttributes()
+        entry.st_ino = inode
+        if inode == CONTROL_INODE:
+            entry.st_mode = stat.S_IFDIR | 0o555
+            entry.st_nlink = 2
+        else:
+            # the size isn't known up front, files are read with direct_io
+            entry.st_mode = stat.S_IFREG | 0o444
+            entry.st_nlink = 1
+        entry.st_uid = os.getuid()
+        entry.st_gid = os.getgid()
+        entry.st_blksize = self.blksize
+        entry.st_atime_ns = entry.st_mtime_ns = entry.st_ctime_ns = int(self.metrics.started * 1e9)
+        entry.attr_timeout = self.attr_timeout
+        entry.entry_timeout = self.entry_timeout
+        return entry
+
+    def _writable(self, *inodes):
+        if not VIRTUAL_INODES.isdisjoint(inodes):
+            raise pyfuse3.FUSEError(errno.EPERM)
+
+    def _removable(self, parent_inode, name):
+        # /.sqlfs hides whatever is stored under that name
+        self._writable(parent_inode)
+        if self.stats and parent_inode == pyfuse3.ROOT_INODE and name == CONTROL_NAME:
+            raise pyfuse3.FUSEError(errno.EPERM)
 
     def _to_entry(self, row):
         entry = pyfuse3.EntryAttributes()
@@ -342,94 +1239,335 @@ class Operations(pyfuse3.Operations):
         entry.st_rdev = row['rdev']
         entry.st_size = row['size']
         entry.st_blksize = self.blksize
-        entry.st_blocks = row['nblock']
+        # in 512 byte units
+        entry.st_blocks = row['nblock'] << (self.blkshft - 9)
         entry.st_atime_ns = row['atime_ns']
         entry.st_mtime_ns = row['mtime_ns']
         entry.st_ctime_ns = row['ctime_ns']
+        entry.attr_timeout = self.attr_timeout
+        entry.entry_timeout = self.entry_timeout
+        # pending writes not yet flushed to the database
+        pending = self.writeback.get_inode(entry.st_ino)
+        if pending:
+            entry.st_size = pending.get('size', entry.st_size)
+            entry.st_mtime_ns = pending.get('mtime_ns', entry.st_mtime_ns)
+            entry.st_ctime_ns = pending.get('ctime_ns', entry.st_ctime_ns)
         return entry
 
+    def _get_inode(self, inode):
+        row = self.attrs.get(inode)
+        if row is None:
+            generation = self.attrs.generation
+            row = self.db.get_inode_from_id(inode)
+            if row:
+                self.attrs.fill(row, generation)
+        return row
+
     def _get_entry(self, inode):
-        row = self.db.get_inode_from_id(inode)
+        row = self._get_inode(inode)
         if not row:
             raise pyfuse3.FUSEError(errno.EINVAL)
         return self._to_entry(row)
 
+    def _lookup(self, inode):
+        with self.lookups_lock:
+            self.lookups[inode] = self.lookups.get(inode, 0) + 1
+
+    def _reclaim(self, inode):
+        # delete an inode that is neither linked nor known to the kernel
+        with self.lookups_lock:
+            if inode in self.lookups:
+                return False
+        row = self.db.get_inode_from_id(inode)
+        if not row or row['nlink'] or row['nchild']:
+            return False
+        self.writeback.discard(inode)
+        self.cache.discard(inode)
+        self.attrs.discard(inode)
+        self.db.delete_inode(inode)
+        return True
+
+    def _flush(self):
+        self.attrs.discard(*self.writeback.flush())
+
     async def access(self, inode, mode, ctx):
         return True
 
     def _create(self, parent_inode, name, uid, gid, mode, **kwargs):
         inode = self.db.create_inode(parent_inode, name, uid, gid, mode, **kwargs)
         self.db.commit()
+        self.attrs.discard(parent_inode)
+        self._lookup(inode)
         return self._get_entry(inode)
 
-    async def create(self, parent_inode, name, mode, flags, ctx):
+    @_dbop()
+    def create(self, parent_inode, name, mode, flags, ctx):
+        self._writable(parent_inode)
         entry = self._create(parent_inode, name, ctx.uid, ctx.gid, mode)
-        return pyfuse3.FileInfo(fh=entry.st_ino), entry
+        return self._open(entry), entry
+
+    @_dbop()
+    def forget(self, inode_list):
+        reclaimed = False
+        for inode, nlookup in inode_list:
+            # never stored, so there is nothing to reclaim
+            if inode in VIRTUAL_INODES:
+                continue
+            with self.lookups_lock:
+                nlookup = self.lookups.get(inode, 0) - nlookup
+                if nlookup > 0:
+                    self.lookups[inode] = nlookup
+                    continue
+                self.lookups.pop(inode, None)
+            self.attrs.discard(inode)
+            self.opened.pop(inode, None)
+            reclaimed |= self._reclaim(inode)
+        if reclaimed:
+            self.db.commit()
 
-    async def getattr(self, inode, ctx):
+    @_dbop(readonly=True)
+    def getattr(self, inode, ctx):
+        if inode in VIRTUAL_INODES:
+            return self._virtual_entry(inode)
         return self._get_entry(inode)
 
-    async def link(self, inode, new_parent_inode, new_name, ctx):
+    @_dbop(readonly=True)
+    def getxattr(self, inode, name, ctx):
+        if inode in VIRTUAL_INODES:
+            raise pyfuse3.FUSEError(pyfuse3.ENOATTR)
+        # the xattr count in the cached inode row answers most lookups
+        row = self._get_inode(inode)
+        if not row:
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        value = self.db.get_xattr(inode, name) if row['nxattr'] else None
+        if value is None:
+            raise pyfuse3.FUSEError(pyfuse3.ENOATTR)
+        return value
+
+    @_dbop()
+    def link(self, inode, new_parent_inode, new_name, ctx):
+        self._writable(inode, new_parent_inode)
         inode = self.db.create_link(inode, new_parent_inode, new_name)
         self.db.commit()
+        self.attrs.discard(inode, new_parent_inode)
+        self._lookup(inode)
         return self._get_entry(inode)
 
-    async def lookup(self, parent_inode, name, ctx):
+    @_dbop(readonly=True)
+    def listxattr(self, inode, ctx):
+        if inode in VIRTUAL_INODES:
+            return []
+        row = self._get_inode(inode)
+        if not row:
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        return self.db.get_xattrs(inode) if row['nxattr'] else []
+
+    @_dbop(readonly=True)
+    def lookup(self, parent_inode, name, ctx):
+        if self.stats:
+            if parent_inode == pyfuse3.ROOT_INODE and name == CONTROL_NAME:
+                return self._virtual_entry(CONTROL_INODE)
+            if parent_inode == CONTROL_INODE:
+                if name == STATS_NAME:
+                    return self._virtual_entry(STATS_INODE)
+                raise pyfuse3.FUSEError(errno.ENOENT)
+        generation = self.attrs.generation
         row = self.db.get_inode_from_parent_and_name(parent_inode, name)
         if not row:
             raise pyfuse3.FUSEError(errno.ENOENT)
+        self.attrs.fill(row, generation)
+        self._lookup(row['id'])
         return self._to_entry(row)
 
-    async def mkdir(self, parent_inode, name, mode, ctx):
+    @_dbop()
+    def mkdir(self, parent_inode, name, mode, ctx):
+        self._writable(parent_inode)
         return self._create(parent_inode, name, ctx.uid, ctx.gid, mode)
 
-    async def mknod(self, parent_inode, name, mode, rdev, ctx):
+    @_dbop()
+    def mknod(self, parent_inode, name, mode, rdev, ctx):
+        self._writable(parent_inode)
         return self._create(parent_inode, name, ctx.uid, ctx.gid, mode, rdev=rdev)
 
-    async def open(self, inode, flags, ctx):
+    @_dbop()
+    def flush(self, fh):
+        self._flush()
+
+    @_dbop()
+    def fsync(self, fh, datasync):
+        self._flush()
+
+    def _handle(self, inode):
+        fh = next(self.fhs)
+        self.handles[fh] = FileHandle(inode)
+        return fh
+
+    def _open(self, entry):
+        version = (entry.st_mtime_ns, entry.st_size)
+        keep_cache = self.opened.get(entry.st_ino) == version
+        self.opened[entry.st_ino] = version
+        return pyfuse3.FileInfo(fh=self._handle(entry.st_ino), keep_cache=keep_cache)
+
+    @_dbop()
+    def open(self, inode, flags, ctx):
+        if inode in VIRTUAL_INODES:
+            if flags & (os.O_WRONLY | os.O_RDWR | os.O_TRUNC):
+                raise pyfuse3.FUSEError(errno.EACCES)
+            return pyfuse3.FileInfo(fh=self._handle(inode), direct_io=True)
         if flags & os.O_TRUNC:
+            self.writeback.discard(inode)
+            self.cache.discard(inode)
             self.db.truncate_blocks(inode, 0)
             self.db.update_inode(inode, size=0)
             self.db.commit()
-        return pyfuse3.FileInfo(fh=inode)
+            # blocks readers cached before the commit are gone now
+            self.cache.discard(inode)
+            self.attrs.discard(inode)
+        return self._open(self._get_entry(inode))
 
     async def opendir(self, inode, ctx):
         return inode
 
-    async def read(self, fh, off, size):
-        row = self.db.get_inode_from_id(fh)
+    def _size(self, row):
+        return self.writeback.get_inode(row['id']).get('size', row['size'])
+
+    def _get_blocks(self, inode, first_idx, last_idx):
+        # taken before looking anywhere, a write landing after the lookups
+        # below then keeps what is read from the database out of the cache
+        generation = self.cache.generation
+        blocks = dict(self.writeback.get_blocks(inode, first_idx, last_idx))
+        missing = []
+        for idx in range(first_idx, last_idx + 1):
+            if idx not in blocks:
+                data = self.cache.get_block(inode, idx)
+                if data is None:
+                    missing.append(idx)
+                else:
+                    blocks[idx] = data
+        if missing:
+            found = {}
+            for idx, data in self.db.get_blocks(inode, missing[0], missing[-1]):
+                found[idx] = data
+            # holes are cached too so they don't go back to the database
+            for idx in missing:
+                data = found.get(idx, b'')
+                self.cache.fill_block(inode, idx, data, generation)
+                blocks[idx] = data
+        return blocks
+
+    def _get_block(self, inode, idx):
+        return self._get_blocks(inode, idx, idx).get(idx, b'')
+
+    @_dbop(readonly=True)
+    def read(self, fh, off, size):
+        handle = self.handles[fh]
+        if handle.inode == STATS_INODE:
+            # rendered once per pass through the file
+            if not off:
+                self.stats_data = json.dumps(self.get_stats(), indent=2).encode() + b'\n'
+            return self.stats_data[off:off + size]
+        if self.readahead:
+            self._readahead(handle, off, size)
+        return self._read(handle.inode, off, size)
+
+    def _readahead(self, handle, off, size):
+        # sequential reads fetch the blocks after them into the block cache
+        # with one query, the window doubles each time reads catch up with it
+        # and starts over when they stop being sequential
+        sequential = off == handle.next_off
+        handle.next_off = off + size
+        if not sequential:
+            handle.window = handle.ahead_idx = 0
+            return
+        row = self._get_inode(handle.inode)
+        b_idxn = (off + size - 1) >> self.blkshft
+        if not row or b_idxn < handle.ahead_idx:
+            return
+        handle.window = min(max(handle.window * 2, size), self.readahead)
+        end_idx = (min(off + size + handle.window, self._size(row)) - 1) >> self.blkshft
+        if end_idx > b_idxn:
+            self._get_blocks(handle.inode, off >> self.blkshft, end_idx)
+            handle.ahead_idx = end_idx + 1
+
+    def _read(self, inode, off, size):
+        row = self._get_inode(inode)
         if not row:
             raise pyfuse3.FUSEError(errno.EINVAL)
-        inode_size = row['size']
+        inode_size = self._size(row)
         if size == 0 or off >= inode_size:
             return b''
         size = min(size, inode_size - off)
-        f_idx0, f_idxn = off, off + size - 1
-        b_idx0, b_idxn = f_idx0 >> self.blkshft, f_idxn >> self.blkshft
-        b_cnt = b_idxn - b_idx0 + 1
-        buf = bytearray(b_cnt << self.blkshft)
-        for block in self.db.get_blocks(fh, b_idx0, b_idxn):
-            data = block['data']
-            buf_idx = (block['idx'] - b_idx0) << self.blkshft
-            buf[buf_idx:buf_idx + len(data)] = data
-        f_aln0 = f_idx0 & self.blkmask
-        return bytes(buf[f_aln0:f_aln0 + size])
-
-    async def readdir(self, fh, start_id, token):
+        f_end = off + size
+        b_idx0, b_idxn = off >> self.blkshft, (f_end - 1) >> self.blkshft
+        blocks = self._get_blocks(inode, b_idx0, b_idxn)
+        if not any(blocks.values()):
+            return bytes(size)
+        f_aln0 = off & self.blkmask
+        if b_idx0 == b_idxn:
+            data = blocks[b_idx0]
+            if not f_aln0 and len(data) == size:
+                return data
+            data = data[f_aln0:f_aln0 + size]
+            return data + bytes(size - len(data)) if len(data) < size else data
+        # the pieces of each block, and zeros for what blocks don't store,
+        # are copied once by join
+        parts = []
+        for idx in range(b_idx0, b_idxn + 1):
+            lo = f_aln0 if idx == b_idx0 else 0
+            hi = ((f_end - 1) & self.blkmask) + 1 if idx == b_idxn else self.blksize
+            data = memoryview(blocks[idx])[lo:hi]
+            parts.append(data)
+            if len(data) < hi - lo:
+                parts.append(bytes(hi - lo - len(data)))
+        return b''.join(parts)
+
+    @_dbop(readonly=True)
+    def readdir(self, fh, start_id, token):
+        if fh == CONTROL_INODE:
+            names = [b'.', b'..', STATS_NAME]
+            inodes = [CONTROL_INODE, pyfuse3.ROOT_INODE, STATS_INODE]
+            for next_id in range(start_id, len(names)):
+                entry = self._virtual_entry(inodes[next_id]) if next_id != 1 else self._get_entry(inodes[next_id])
+                if not pyfuse3.readdir_reply(token, names[next_id], entry, next_id + 1):
+                    break
+            return
+        generation = self.attrs.generation
         for row in self.db.get_inodes_from_parent(fh, start_id):
             entry = self._to_entry(row)
             if not pyfuse3.readdir_reply(token, row['name'], entry, row['link_id']):
                 break
+            if row['name'] not in (b'.', b'..'):
+                self._lookup(row['id'])
+                # the kernel usually stats what it just listed
+                self.attrs.fill(row, generation)
 
-    async def readlink(self, inode, ctx):
-        row = self.db.get_inode_from_id(inode)
+    @_dbop(readonly=True)
+    def readlink(self, inode, ctx):
+        row = self._get_inode(inode)
         if not row:
             raise pyfuse3.FUSEError(errno.EINVAL)
         if not stat.S_ISLNK(row['mode']):
             raise pyfuse3.FUSEError(errno.EINVAL)
         return row['target']
 
-    async def rename(self, parent_inode_old, name_old, parent_inode_new, name_new, flags, ctx):
+    @_dbop()
+    def removexattr(self, inode, name, ctx):
+        self._writable(inode)
+        if not self.db.delete_xattr(inode, name):
+            raise pyfuse3.FUSEError(pyfuse3.ENOATTR)
+        self.db.update_inode(inode, ctime_ns=_timestamp_ns())
+        self.db.commit()
+        self.attrs.discard(inode)
+
+    def _move_dir(self, row, parent_inode_old, parent_inode_new):
+        # directories moving to another parent also move their '..' link
+        if stat.S_ISDIR(row['mode']) and parent_inode_old != parent_inode_new:
+            self.db.update_link_parent(row['id'], parent_inode_new)
+
+    @_dbop()
+    def rename(self, parent_inode_old, name_old, parent_inode_new, name_new, flags, ctx):
+        self._removable(parent_inode_old, name_old)
+        self._removable(parent_inode_new, name_new)
         inode_moved = self.db.get_inode_from_parent_and_name(parent_inode_old, name_old)
         if not inode_moved:
             raise pyfuse3.FUSEError(errno.EINVAL)
@@ -440,35 +1578,64 @@ class Operations(pyfuse3.Operations):
             elif flags & pyfuse3.RENAME_EXCHANGE:
                 self.db.update_link(inode_deref['link_id'], inode=inode_moved['id'])
                 self.db.update_link(inode_moved['link_id'], inode=inode_deref['id'])
+                self._move_dir(inode_moved, parent_inode_old, parent_inode_new)
+                self._move_dir(inode_deref, parent_inode_new, parent_inode_old)
                 self.db.commit()
+                self.attrs.discard(inode_deref['id'])
             else:
                 if inode_deref['nchild']:
                     raise pyfuse3.FUSEError(errno.ENOTEMPTY)
                 self.db.update_link(inode_deref['link_id'], inode=inode_moved['id'])
                 self.db.delete_link(inode_moved['link_id'])
-                # need to delete inode - read doco its confusing for now just
-                # cleanup orphaned inodes on umount
+                self._move_dir(inode_moved, parent_inode_old, parent_inode_new)
+                self._reclaim(inode_deref['id'])
                 self.db.commit()
+                self.attrs.discard(inode_deref['id'])
         else:
             self.db.update_link(inode_moved['link_id'], parent_inode=parent_inode_new, name=name_new)
+            self._move_dir(inode_moved, parent_inode_old, parent_inode_new)
             self.db.commit()
+        # the parents' child and link counts changed
+        self.attrs.discard(inode_moved['id'], parent_inode_old, parent_inode_new)
 
-    async def rmdir(self, parent_inode, name, ctx):
+    @_dbop()
+    def rmdir(self, parent_inode, name, ctx):
+        self._removable(parent_inode, name)
         row = self.db.get_inode_from_parent_and_name(parent_inode, name)
+        if not row:
+            raise pyfuse3.FUSEError(errno.ENOENT)
         if not stat.S_ISDIR(row['mode']):
             raise pyfuse3.FUSEError(errno.ENOTDIR)
         if row['nchild'] > 2:
             raise pyfuse3.FUSEError(errno.ENOTEMPTY)
         self.db.delete_link_dir(row['id'])
-        # need to delete inode - for now just cleanup orphaned inodes on umount
+        self._reclaim(row['id'])
         self.db.commit()
+        self.attrs.discard(row['id'], parent_inode)
 
-    async def setattr(self, inode, attr, fields, fh, ctx):
+    @_dbop()
+    def setattr(self, inode, attr, fields, fh, ctx):
+        self._writable(inode)
         update_kwargs = {}
         if fields.update_size:
-            update_kwargs['size'] = attr.st_size
-            block_idx = attr.st_size >> self.blkshft
-            self.db.truncate_blocks(inode, block_idx + 1)
+            size = attr.st_size
+            update_kwargs['size'] = size
+            block_idx = (size + self.blkmask) >> self.blkshft
+            self.writeback.truncate_blocks(inode, block_idx)
+            self.cache.truncate_blocks(inode, block_idx)
+            self.db.truncate_blocks(inode, block_idx)
+            # zero the end of the last block so that extending the file
+            # again reads back zeros
+            f_aln = size & self.blkmask
+            if f_aln:
+                data = self._get_block(inode, block_idx - 1)
+                if len(data) > f_aln:
+                    data = bytes(data[:f_aln]).rstrip(b'\x00')
+                    self.writeback.update_block(inode, block_idx - 1, data)
+                    self.cache.update_block(inode, block_idx - 1, data)
+        # apply pending writes first so they don't clobber these attributes
+        if inode in self.writeback:
+            self._flush()
         if fields.update_mode:
             update_kwargs['mode'] = attr.st_mode
         if fields.update_uid:
@@ -485,8 +1652,20 @@ class Operations(pyfuse3.Operations):
             update_kwargs['ctime_ns'] = _timestamp_ns()
         self.db.update_inode(inode, **update_kwargs)
         self.db.commit()
+        if fields.update_size:
+            # blocks readers cached before the commit are gone now
+            self.cache.truncate_blocks(inode, block_idx)
+        self.attrs.discard(inode)
         return self._get_entry(inode)
 
+    @_dbop()
+    def setxattr(self, inode, name, value, ctx):
+        self._writable(inode)
+        self.db.update_xattr(inode, name, value)
+        self.db.update_inode(inode, ctime_ns=_timestamp_ns())
+        self.db.commit()
+        self.attrs.discard(inode)
+
     @staticmethod
     def _memfree():
         with open('/proc/meminfo') as fd:
@@ -495,7 +1674,8 @@ class Operations(pyfuse3.Operations):
                 if parts[0] == 'MemFree:':
                     return int(parts[1]) * 1024
 
-    async def statfs(self, ctx):
+    @_dbop(readonly=True)
+    def statfs(self, ctx):
         stats = self.db.get_stats()
 
         # base it off free memory
@@ -529,53 +1709,372 @@ class Operations(pyfuse3.Operations):
         ours.f_namemax = 255
         return ours
 
-    async def symlink(self, parent_inode, name, target, ctx):
+    @_dbop()
+    def symlink(self, parent_inode, name, target, ctx):
+        self._writable(parent_inode)
         mode = stat.S_IFLNK | 0o777
         return self._create(parent_inode, name, ctx.uid, ctx.gid, mode, size=len(target), target=target)
 
-    async def unlink(self, parent_inode, name, ctx):
+    @_dbop()
+    def unlink(self, parent_inode, name, ctx):
+        self._removable(parent_inode, name)
         row = self.db.get_inode_from_parent_and_name(parent_inode, name)
+        if not row:
+            raise pyfuse3.FUSEError(errno.ENOENT)
         if stat.S_ISDIR(row['mode']):
             raise pyfuse3.FUSEError(errno.EISDIR)
         self.db.delete_link(row['link_id'])
-        # need to delete inode - for now just cleanup orphaned inodes on umount
+        self._reclaim(row['id'])
         self.db.commit()
+        self.attrs.discard(row['id'], parent_inode)
 
-    def _blocks(self, buf, inode, b_idx0):
-        idx = b_idx0
-        for i in range(0, len(buf), self.blksize):
-            block = bytes(buf[i:i + self.blksize]).rstrip(b'\x00')
-            yield inode, idx, block
-            idx += 1
+    @_dbop()
+    def write(self, fh, off, buf):
+        inode = self.handles[fh].inode
+        self._writable(inode)
+        return self._write(inode, off, buf)
 
-    async def write(self, fh, off, buf):
-        row = self.db.get_inode_from_id(fh)
+    def _write(self, inode, off, buf):
+        row = self._get_inode(inode)
         if not row:
             raise pyfuse3.FUSEError(errno.EINVAL)
         size = len(buf)
         if not size:
             return 0
         f_end = off + size
-        f_idx0, f_idxn = off, f_end - 1
-        f_aln0, f_alnn = off & self.blkmask, f_end & self.blkmask
-        b_idx0, b_idxn = f_idx0 >> self.blkshft, f_idxn >> self.blkshft
-        b_cnt = b_idxn - b_idx0 + 1
-        _buf = bytearray(b_cnt << self.blkshft)
-        if f_aln0:
-            for block in self.db.get_blocks(fh, b_idx0, b_idx0):
-                data = block['data']
-                _buf[:len(data)] = data
-        if f_alnn:
-            for block in self.db.get_blocks(fh, b_idxn, b_idxn):
-                data = block['data']
-                _buf[-self.blksize:len(data) - self.blksize] = data
-        _buf[f_aln0:f_aln0 + len(buf)] = buf
-        self.db.update_blocks(self._blocks(memoryview(_buf), fh, b_idx0))
-        if f_end > row['size']:
-            now_ns = _timestamp_ns()
-            self.db.update_inode(fh, size=f_end, ctime_ns=now_ns, mtime_ns=now_ns)
-        self.db.commit()
+        b_idx0, b_idxn = off >> self.blkshft, (f_end - 1) >> self.blkshft
+        inode_size = self._size(row)
+        view = memoryview(buf)
+        for idx in range(b_idx0, b_idxn + 1):
+            b_off = idx << self.blkshft
+            lo = max(off, b_off) - b_off
+            hi = min(f_end, b_off + self.blksize) - b_off
+            piece = view[b_off + lo - off:b_off + hi - off]
+            if hi - lo == self.blksize:
+                # whole blocks are taken straight from the buffer
+                data = buf if size == self.blksize and isinstance(buf, bytes) else bytes(piece)
+            else:
+                # partial blocks are merged with the stored block, there is
+                # nothing to merge with past the end of the file
+                merged = bytearray(self._get_block(inode, idx) if b_off < inode_size else b'')
+                if len(merged) < hi:
+                    merged.extend(bytes(hi - len(merged)))
+                merged[lo:hi] = piece
+                data = bytes(merged)
+            data = data.rstrip(b'\x00')
+            self.writeback.update_block(inode, idx, data)
+            self.cache.update_block(inode, idx, data)
+        now_ns = _timestamp_ns()
+        if f_end > inode_size:
+            self.writeback.update_inode(inode, size=f_end, ctime_ns=now_ns, mtime_ns=now_ns)
+        else:
+            self.writeback.update_inode(inode, ctime_ns=now_ns, mtime_ns=now_ns)
+        if self.writeback.expired:
+            self._flush()
         return size
 
+    @_dbop()
+    def copy_file_range(self, fh_in, off_in, fh_out, off_out, length, flags):
+        inode_in, inode_out = self.handles[fh_in].inode, self.handles[fh_out].inode
+        self._writable(inode_in, inode_out)
+        row_in = self._get_inode(inode_in)
+        row_out = self._get_inode(inode_out)
+        if not row_in or not row_out:
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        length = min(length, self._size(row_in) - off_in)
+        size_out = self._size(row_out)
+        if length <= 0:
+            return 0
+        if inode_in == inode_out and off_in < off_out + length and off_out < off_in + length:
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        head = -off_in & self.blkmask
+        count = max(0, (length - head) >> self.blkshft)
+        # whole blocks are copied inside the database when both ranges line up
+        # the same way, only the partial blocks at the edges pass through here
+        if (off_in - off_out) & self.blkmask or not count:
+            return self._copy(inode_in, off_in, inode_out, off_out, length)
+        if inode_in in self.writeback or inode_out in self.writeback:
+            self._flush()
+        self.db.copy_blocks(inode_in, (off_in + head) >> self.blkshft, inode_out, (off_out + head) >> self.blkshft, count)
+        if head:
+            self._write(inode_out, off_out, self._read(inode_in, off_in, head))
+        copied = head + (count << self.blkshft)
+        if copied < length:
+            self._write(inode_out, off_out + copied, self._read(inode_in, off_in + copied, length - copied))
+        now_ns = _timestamp_ns()
+        if off_out + length > size_out:
+            self.writeback.update_inode(inode_out, size=off_out + length, ctime_ns=now_ns, mtime_ns=now_ns)
+        else:
+            self.writeback.update_inode(inode_out, ctime_ns=now_ns, mtime_ns=now_ns)
+        # commits the copied blocks together with the edges and the new size
+        self._flush()
+        self.cache.discard(inode_out)
+        return length
+
+    def _copy(self, inode_in, off_in, inode_out, off_out, length):
+        # a single request can be close to 2G, each piece may flush the
+        # write-back cache before the next
+        step = max(self.copy_size, self.blksize)
+        for copied in range(0, length, step):
+            size = min(step, length - copied)
+            self._write(inode_out, off_out + copied, self._read(inode_in, off_in + copied, size))
+        return length
+
+    def _zero(self, inode, start, end):
+        # whole blocks are deleted, partial ones have zeros written over them
+        first_idx = (start + self.blkmask) >> self.blkshft
+        end_idx = end >> self.blkshft
+        if first_idx >= end_idx:
+            self._write(inode, start, bytes(end - start))
+            return False
+        if inode in self.writeback:
+            self._flush()
+        self.db.delete_block_range(inode, first_idx, end_idx)
+        if start < first_idx << self.blkshft:
+            self._write(inode, start, bytes((first_idx << self.blkshft) - start))
+        if end > end_idx << self.blkshft:
+            self._write(inode, end_idx << self.blkshft, bytes(end - (end_idx << self.blkshft)))
+        return True
+
+    @_dbop()
+    def fallocate(self, fh, mode, off, length):
+        inode = self.handles[fh].inode
+        self._writable(inode)
+        row = self._get_inode(inode)
+        if not row or length <= 0:
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        if mode & ~(FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE | FALLOC_FL_ZERO_RANGE):
+            raise pyfuse3.FUSEError(errno.EOPNOTSUPP)
+        if mode & FALLOC_FL_PUNCH_HOLE and not mode & FALLOC_FL_KEEP_SIZE:
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        size = self._size(row)
+        end = off + length
+        deleted = False
+        changed = {}
+        # past the end of the file is a hole already
+        if mode & (FALLOC_FL_PUNCH_HOLE | FALLOC_FL_ZERO_RANGE) and off < size:
+            deleted = self._zero(inode, off, min(end, size))
+            changed['mtime_ns'] = changed['ctime_ns'] = _timestamp_ns()
+        # blocks are only stored once they hold data, so there is nothing to
+        # allocate, extending the file is enough
+        if end > size and not mode & FALLOC_FL_KEEP_SIZE:
+            changed['size'] = end
+            changed['mtime_ns'] = changed['ctime_ns'] = _timestamp_ns()
+        if changed:
+            self.writeback.update_inode(inode, **changed)
+        self._flush()
+        if deleted:
+            self.cache.discard(inode)
+
+    @_dbop()
+    def lseek(self, fh, off, whence):
+        # SEEK_DATA and SEEK_HOLE, blocks without a row are holes
+        inode = self.handles[fh].inode
+        row = self._get_inode(inode)
+        if not row:
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        if whence not in (os.SEEK_DATA, os.SEEK_HOLE):
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        inode_size = self._size(row)
+        if off >= inode_size:
+            raise pyfuse3.FUSEError(errno.ENXIO)
+        if inode in self.writeback:
+            self._flush()
+        b_idx = off >> self.blkshft
+        if whence == os.SEEK_DATA:
+            idx = self.db.get_next_data(inode, b_idx)
+            if idx is None or idx << self.blkshft >= inode_size:
+                raise pyfuse3.FUSEError(errno.ENXIO)
+            return max(off, idx << self.blkshft)
+        idx = self.db.get_next_hole(inode, b_idx)
+        return min(inode_size, max(off, idx << self.blkshft))
+
+    @_dbop()
+    def release(self, fh):
+        self.handles.pop(fh, None)
+        self._flush()
+
+    @_dbop(background=True)
+    def _housekeeping(self):
+        if self.writeback.expired:
+            self._flush()
+        # give free pages back to the file system a little at a time
+        if self.vacuum_pages and time.monotonic() - self.active >= self.idle_time:
+            self.db.incremental_vacuum(self.vacuum_pages)
+
+    async def housekeeping(self, interval=1.0):
+        while True:
+            await trio.sleep(interval)
+            await self._housekeeping()
+
+    async def snapshot(self, path=None):
+        # copy the database a few pages at a time, holding the writer's slot
+        # during each step so the copy is consistent
+        borrower = object()
+        self.snapshotting = True
+        await self.write_limiter.acquire_on_behalf_of(borrower)
+        try:
+            await trio.to_thread.run_sync(self._flush)
+
+            def progress(status, remaining, total):
+                trio.from_thread.run(self._snapshot_pause, borrower)
+
+            await trio.to_thread.run_sync(self.db.backup, path or self.snapshot_path, self.snapshot_pages, progress)
+        finally:
+            self.write_limiter.release_on_behalf_of(borrower)
+            self.snapshotting = False
+
+    async def _snapshot_pause(self, borrower):
+        # requests waiting for the slot get it before the next step
+        self.write_limiter.release_on_behalf_of(borrower)
+        await self.write_limiter.acquire_on_behalf_of(borrower)
+
     def close(self):
-        self.db.close()
+        if self.profile:
+            self.dump_profile()
+        self._flush()
+        self.db.close(vacuum=self.vacuum)
+
+
+# named sets of options, options given alongside take precedence
+TUNINGS = {
+    # fewer syncs and more memory, a crash may lose the last transactions
+    'throughput': {
+        'wal': True,
+        'synchronous': 'normal',
+        'page_cache': 64 << 20,
+        'mmap_size': 256 << 20,
+        'temp_store': 'memory',
+    },
+    # writes are committed as they happen and every commit is synced
+    'durable': {
+        'synchronous': 'full',
+        'writeback_size': 0,
+    },
+}
+
+
+# bytes read from a file per import job
+IMPORT_SEGMENT = 8 << 20
+# bytes of file data imported per transaction
+IMPORT_COMMIT = 256 << 20
+
+
+def _read_segment(path, off, size, blksize):
+    with open(path, 'rb') as fd:
+        fd.seek(off)
+        data = fd.read(size)
+    blocks = []
+    for i in range(0, len(data), blksize):
+        block = data[i:i + blksize].rstrip(b'\x00')
+        if block:
+            blocks.append(((off + i) // blksize, block))
+    return blocks
+
+
+def import_tree(db, src, jobs=1):
+    # copy a directory tree into the database without going through fuse,
+    # files are read by a pool of threads and written in large transactions
+    src = os.fsencode(src)
+    segment = max(IMPORT_SEGMENT, db.blksize)
+    st = os.lstat(src)
+    db.update_inode(1, uid=st.st_uid, gid=st.st_gid, mode=st.st_mode,
+                    mtime_ns=st.st_mtime_ns, atime_ns=st.st_atime_ns, ctime_ns=st.st_ctime_ns)
+    hardlinks = {}
+    pending = collections.deque()
+    written = 0
+
+    def write_blocks(inode, future):
+        nonlocal written
+        blocks = future.result()
+        db.update_blocks((inode, idx, data) for idx, data in blocks)
+        written += sum(len(data) for _, data in blocks)
+        if written >= IMPORT_COMMIT:
+            db.commit()
+            written = 0
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        dirs = [(src, 1)]
+        while dirs:
+            path, parent_inode = dirs.pop()
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+            for entry in entries:
+                st = entry.stat(follow_symlinks=False)
+                key = (st.st_dev, st.st_ino)
+                if key in hardlinks:
+                    db.create_link(hardlinks[key], parent_inode, entry.name)
+                    continue
+                kwargs = {'mtime_ns': st.st_mtime_ns, 'atime_ns': st.st_atime_ns, 'ctime_ns': st.st_ctime_ns}
+                if stat.S_ISLNK(st.st_mode):
+                    target = os.readlink(entry.path)
+                    kwargs.update(size=len(target), target=target)
+                elif stat.S_ISREG(st.st_mode):
+                    kwargs.update(size=st.st_size)
+                elif not stat.S_ISDIR(st.st_mode):
+                    kwargs.update(rdev=st.st_rdev)
+                inode = db.create_inode(parent_inode, entry.name, st.st_uid, st.st_gid, st.st_mode, **kwargs)
+                if stat.S_ISDIR(st.st_mode):
+                    dirs.append((entry.path, inode))
+                    continue
+                if st.st_nlink > 1:
+                    hardlinks[key] = inode
+                if stat.S_ISREG(st.st_mode):
+                    for off in range(0, st.st_size, segment):
+                        future = executor.submit(_read_segment, entry.path, off, segment, db.blksize)
+                        pending.append((inode, future))
+                        while len(pending) > jobs * 2:
+                            write_blocks(*pending.popleft())
+        while pending:
+            write_blocks(*pending.popleft())
+    db.commit()
+
+
+def export_tree(db, dst):
+    # copy the database out to a directory tree, holes are left unwritten so
+    # sparse files stay sparse
+    dst = os.fsencode(dst)
+    os.makedirs(dst, exist_ok=True)
+    exported = {}
+    dirs = [(dst, db.get_inode_from_id(1))]
+    attrs = []
+    while dirs:
+        path, row = dirs.pop()
+        attrs.append((path, row))
+        for child in db.get_inodes_from_parent(row['id']).fetchall():
+            if child['name'] in (b'.', b'..'):
+                continue
+            child_path = os.path.join(path, child['name'])
+            mode = child['mode']
+            if child['id'] in exported:
+                os.link(exported[child['id']], child_path)
+                continue
+            if stat.S_ISDIR(mode):
+                os.mkdir(child_path)
+                dirs.append((child_path, child))
+                continue
+            if stat.S_ISLNK(mode):
+                os.symlink(child['target'], child_path)
+            elif stat.S_ISREG(mode):
+                with open(child_path, 'wb') as fd:
+                    if child['size']:
+                        last_idx = (child['size'] - 1) // db.blksize
+                        for idx, data in db.get_blocks(child['id'], 0, last_idx):
+                            fd.seek(idx * db.blksize)
+                            fd.write(data)
+                    fd.truncate(child['size'])
+            else:
+                os.mknod(child_path, mode, child['rdev'])
+            if child['nlink'] > 1:
+                exported[child['id']] = child_path
+            attrs.append((child_path, child))
+    # children before their directory, so creating them doesn't change the
+    # directory's times again
+    for path, row in reversed(attrs):
+        try:
+            os.chown(path, row['uid'], row['gid'], follow_symlinks=False)
+        except PermissionError:
+            pass
+        if not stat.S_ISLNK(row['mode']):
+            os.chmod(path, stat.S_IMODE(row['mode']))
+        os.utime(path, ns=(row['atime_ns'], row['mtime_ns']), follow_symlinks=False)
@@ -1,3 +1,6 @@
+import os
+import sqlite3
+import tempfile
 import unittest
 import sqlfs
 
@@ -11,3 +14,195 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(1, self.db.conn.execute('SELECT COUNT(*) FROM inode').fetchone()[0])
         self.assertEqual(2, self.db.conn.execute('SELECT COUNT(*) FROM link').fetchone()[0])
         self.assertEqual(0, self.db.conn.execute('SELECT COUNT(*) FROM block').fetchone()[0])
+
+    def test_get_inodes_from_parent(self):
+        for i in range(10):
+            self.db.create_inode(1, b'file%d' % (9 - i), 0, 0, 0o100644)
+        rows = list(self.db.get_inodes_from_parent(1))
+        self.assertEqual([row['name'] for row in rows[2:]], [b'file%d' % (9 - i) for i in range(10)])
+        resumed = list(self.db.get_inodes_from_parent(1, rows[5]['link_id']))
+        self.assertEqual([row['link_id'] for row in resumed], [row['link_id'] for row in rows[6:]])
+
+    def test_update_inodes(self):
+        inodes = [self.db.create_inode(1, b'file%d' % i, 0, 0, 0o100644, size=i) for i in range(3)]
+        self.db.update_inodes([(inodes[0], {'size': 10}), (inodes[1], {}), (inodes[2], {'size': 12, 'uid': 5})])
+        rows = [self.db.get_inode_from_id(inode) for inode in inodes]
+        self.assertEqual([(row['size'], row['uid']) for row in rows], [(10, 0), (1, 0), (12, 5)])
+        self.db.update_inode(inodes[1], mode=0o100600)
+        self.assertEqual(self.db.get_inode_from_id(inodes[1])['mode'], 0o100600)
+
+    def test_import_export(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src, dst = os.path.join(tmp, 'src'), os.path.join(tmp, 'dst')
+            os.makedirs(os.path.join(src, 'dir'))
+            with open(os.path.join(src, 'dir', 'file'), 'wb') as fd:
+                fd.write(b'a' * 5000)
+                fd.seek(3 << 20)
+                fd.write(b'b')
+            os.link(os.path.join(src, 'dir', 'file'), os.path.join(src, 'hardlink'))
+            os.symlink('dir/file', os.path.join(src, 'symlink'))
+            os.utime(os.path.join(src, 'dir'), ns=(10 ** 9, 2 * 10 ** 9))
+            sqlfs.import_tree(self.db, src, jobs=2)
+            self.assertEqual(self.db.get_inode_from_parent_and_name(1, b'hardlink')['nlink'], 2)
+            sqlfs.export_tree(self.db, dst)
+            with open(os.path.join(dst, 'dir', 'file'), 'rb') as fd:
+                self.assertEqual(fd.read(), b'a' * 5000 + bytes((3 << 20) - 5000) + b'b')
+            st = os.stat(os.path.join(dst, 'hardlink'))
+            self.assertEqual((st.st_nlink, st.st_size), (2, (3 << 20) + 1))
+            self.assertLess(st.st_blocks * 512, 1 << 20)
+            self.assertEqual(os.readlink(os.path.join(dst, 'symlink')), 'dir/file')
+            self.assertEqual(os.stat(os.path.join(dst, 'dir')).st_mtime_ns, 2 * 10 ** 9)
+
+    def test_xattrs(self):
+        inode = self.db.create_inode(1, b'xattrs', 0, 0, 0o100644)
+        self.db.update_xattr(inode, b'user.a', b'1')
+        self.db.update_xattr(inode, b'user.b', b'2')
+        self.db.update_xattr(inode, b'user.a', b'3')
+        self.assertEqual(self.db.get_inode_from_id(inode)['nxattr'], 2)
+        self.assertEqual(self.db.get_xattr(inode, b'user.a'), b'3')
+        self.assertEqual(sorted(self.db.get_xattrs(inode)), [b'user.a', b'user.b'])
+        self.assertEqual(self.db.delete_xattr(inode, b'user.b'), 1)
+        self.assertEqual(self.db.delete_xattr(inode, b'user.b'), 0)
+        self.assertEqual(self.db.get_inode_from_id(inode)['nxattr'], 1)
+        self.db.delete_link(self.db.get_inode_from_parent_and_name(1, b'xattrs')['link_id'])
+        self.db.delete_inode(inode)
+        self.assertEqual(self.db.conn.execute('SELECT COUNT(*) FROM xattr').fetchone()[0], 0)
+
+    def counts(self, inode):
+        return tuple(self.db.conn.execute(
+            '''
+            SELECT
+                (SELECT COUNT(*) FROM link WHERE inode=?1),
+                (SELECT COUNT(*) FROM link WHERE parent_inode=?1),
+                (SELECT COUNT(*) FROM block WHERE inode=?1)
+            ''',
+            (inode,)
+        ).fetchone())
+
+    def stored_counts(self, inode):
+        row = self.db.get_inode_from_id(inode)
+        return row['nlink'], row['nchild'], row['nblock']
+
+    def test_counts(self):
+        self.assertEqual(self.stored_counts(1), (2, 2, 0))
+        parent = self.db.create_inode(1, b'dir', 0, 0, 0o40755)
+        inode = self.db.create_inode(parent, b'file', 0, 0, 0o100644)
+        self.db.create_link(inode, 1, b'other')
+        self.db.update_blocks([(inode, 0, b'a'), (inode, 1, b'b')])
+        self.db.update_blocks([(inode, 1, b'c')])
+        for i in (1, parent, inode):
+            self.assertEqual(self.stored_counts(i), self.counts(i))
+        self.assertEqual(self.stored_counts(inode), (2, 0, 2))
+        row = self.db.get_inode_from_parent_and_name(1, b'other')
+        self.db.update_link(row['link_id'], parent_inode=parent, name=b'moved')
+        self.db.truncate_blocks(inode, 1)
+        for i in (1, parent, inode):
+            self.assertEqual(self.stored_counts(i), self.counts(i))
+        self.assertEqual(self.db.get_stats()['f_blocks'], 1)
+
+    def test_incremental_vacuum(self):
+        self.assertEqual(self.db.conn.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        inode = self.db.create_inode(1, b'file', 0, 0, 0o100644)
+        self.db.update_blocks((inode, idx, b'a' * 4096) for idx in range(64))
+        self.db.commit()
+        self.db.truncate_blocks(inode, 0)
+        self.db.commit()
+        freelist = self.db.conn.execute('PRAGMA freelist_count').fetchone()[0]
+        self.assertTrue(freelist)
+        self.assertEqual(self.db.incremental_vacuum(freelist + 10), freelist)
+        self.assertEqual(self.db.conn.execute('PRAGMA freelist_count').fetchone()[0], 0)
+
+    def test_pragmas(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'fs.db')
+            self.db = sqlfs.Database(db_path, page_size=8192, page_cache=8 << 20, mmap_size=1 << 20, temp_store='memory')
+            pragmas = ('page_size', 'cache_size', 'mmap_size', 'temp_store')
+            values = [self.db.conn.execute(f'PRAGMA {name}').fetchone()[0] for name in pragmas]
+            self.assertEqual(values, [8192, -8192, 1 << 20, 2])
+            self.db.close()
+        # nothing to map for memory databases
+        self.assertNotIn('mmap_size', sqlfs.Database(':memory:', mmap_size=1 << 20).pragmas)
+        with self.assertRaises(ValueError):
+            sqlfs.Database(':memory:', temp_store='disk')
+
+    def test_compression(self):
+        self.db = sqlfs.Database(':memory:', compression='zlib')
+        inode = self.db.create_inode(1, b'file', 0, 0, 0o100644)
+        text, noise = b'abcd' * 1024, os.urandom(4096)
+        self.db.update_blocks([(inode, 0, text), (inode, 1, noise)])
+        rows = self.db.conn.execute('SELECT codec, LENGTH(data) FROM block ORDER BY idx').fetchall()
+        self.assertEqual(rows[0][0], 1)
+        self.assertLess(rows[0][1], len(text))
+        self.assertEqual(tuple(rows[1]), (0, len(noise)))
+        self.assertEqual(list(self.db.get_blocks(inode, 0, 1)), [(0, text), (1, noise)])
+        with self.assertRaises(ValueError):
+            sqlfs.Database(':memory:', compression='unknown')
+
+    def chunks(self):
+        return self.db.conn.execute('SELECT refs FROM chunk ORDER BY id').fetchall()
+
+    def test_dedup(self):
+        self.db = sqlfs.Database(':memory:', dedup=True, compression='zlib')
+        first = self.db.create_inode(1, b'first', 0, 0, 0o100644)
+        second = self.db.create_inode(1, b'second', 0, 0, 0o100644)
+        data = b'abcd' * 1024
+        self.db.update_blocks([(first, 0, data), (first, 1, data), (second, 0, data)])
+        self.assertEqual([tuple(r) for r in self.chunks()], [(3,)])
+        self.assertEqual(list(self.db.get_blocks(second, 0, 0)), [(0, data)])
+        self.db.update_blocks([(first, 1, b'other'), (second, 1, data)])
+        self.assertEqual([tuple(r) for r in self.chunks()], [(3,), (1,)])
+        self.db.truncate_blocks(first, 0)
+        self.assertEqual([tuple(r) for r in self.chunks()], [(2,)])
+        self.db.delete_link(self.db.get_inode_from_parent_and_name(1, b'second')['link_id'])
+        self.db.delete_inode(second)
+        self.assertEqual(self.chunks(), [])
+
+
+class TestDatabaseMigration(unittest.TestCase):
+
+    def test_counts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'fs.db')
+            conn = sqlite3.connect(db_path)
+            conn.executescript(
+                '''
+                CREATE TABLE inode (
+                    id INTEGER PRIMARY KEY,
+                    uid INTEGER NOT NULL,
+                    gid INTEGER NOT NULL,
+                    mode INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    atime_ns INTEGER NOT NULL,
+                    ctime_ns INTEGER NOT NULL,
+                    target BLOB DEFAULT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    rdev INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE link (
+                    id INTEGER PRIMARY KEY,
+                    inode INTEGER NOT NULL,
+                    parent_inode INTEGER NOT NULL,
+                    name BLOB NOT NULL,
+                    UNIQUE (parent_inode, name)
+                );
+                CREATE TABLE block (
+                    inode INTEGER NOT NULL,
+                    idx INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (inode, idx)
+                ) WITHOUT ROWID;
+                INSERT INTO inode VALUES (1, 0, 0, 16877, 0, 0, 0, NULL, 0, 0);
+                INSERT INTO inode VALUES (2, 0, 0, 33188, 0, 0, 0, NULL, 2, 0);
+                INSERT INTO link VALUES (1, 1, 1, X'2E'), (2, 1, 1, X'2E2E'), (3, 2, 1, X'61');
+                INSERT INTO block VALUES (2, 0, X'6161'), (2, 1, X'');
+                '''
+            )
+            conn.close()
+            db = sqlfs.Database(db_path)
+            row = db.get_inode_from_id(2)
+            self.assertEqual((row['nlink'], row['nchild'], row['nblock']), (1, 0, 1))
+            row = db.get_inode_from_id(1)
+            self.assertEqual((row['nlink'], row['nchild'], row['nblock']), (2, 3, 0))
+            self.assertEqual(db.conn.execute('PRAGMA user_version').fetchone()[0], db.version)
+            self.assertEqual(list(db.get_blocks(2, 0, 0)), [(0, b'aa')])
+            db.close()
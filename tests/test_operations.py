@@ -1,4 +1,10 @@
+import os
+import json
+import tempfile
+import types
 import unittest
+import unittest.mock
+import trio
 import sqlfs
 
 
@@ -6,3 +12,431 @@ class TestOperations(unittest.TestCase):
 
     def setUp(self):
         self.ops = sqlfs.Operations(':memory:', key='unused')
+
+    def open(self, inode):
+        return trio.run(self.ops.open, inode, os.O_RDWR, None).fh
+
+    def block_count(self):
+        return self.ops.db.conn.execute('SELECT COUNT(*) FROM block').fetchone()[0]
+
+    def test_writeback(self):
+        inode = self.ops.db.create_inode(1, b'writeback', 0, 0, 0o100644)
+        fh = self.open(inode)
+        bs = self.ops.blksize
+        self.assertEqual(trio.run(self.ops.write, fh, 0, b'a' * bs * 2), bs * 2)
+        self.assertEqual(trio.run(self.ops.write, fh, bs - 1, b'b' * (bs + 2)), bs + 2)
+        self.assertEqual(self.block_count(), 0)
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_size, bs * 2 + 1)
+        data = b'a' * (bs - 1) + b'b' * (bs + 2)
+        self.assertEqual(trio.run(self.ops.read, fh, 0, bs * 3), data)
+        trio.run(self.ops.flush, fh)
+        self.assertEqual(self.block_count(), 3)
+        self.assertEqual(trio.run(self.ops.read, fh, 0, bs * 3), data)
+
+    def test_writeback_disabled(self):
+        self.ops = sqlfs.Operations(':memory:', key='unused', writeback_size=0)
+        inode = self.ops.db.create_inode(1, b'writethrough', 0, 0, 0o100644)
+        fh = self.open(inode)
+        trio.run(self.ops.write, fh, 0, b'abc')
+        self.assertEqual(self.block_count(), 1)
+
+    def test_unaligned(self):
+        inode = self.ops.db.create_inode(1, b'unaligned', 0, 0, 0o100644)
+        fh = self.open(inode)
+        bs = self.ops.blksize
+        data = bytearray(os.urandom(bs * 4))
+        trio.run(self.ops.write, fh, 0, bytes(data))
+        for off, size in ((0, bs), (bs, bs), (3, bs), (bs - 1, 2), (5, bs * 3), (bs + 7, 9)):
+            chunk = os.urandom(size)
+            data[off:off + size] = chunk
+            self.assertEqual(trio.run(self.ops.write, fh, off, chunk), size)
+            self.assertEqual(trio.run(self.ops.read, fh, off, size), chunk)
+        for off in (0, 1, bs - 1, bs, bs * 2 + 3):
+            self.assertEqual(trio.run(self.ops.read, fh, off, bs * 2), bytes(data[off:off + bs * 2]))
+        trio.run(self.ops.write, fh, bs * 6 + 1, b'z')
+        self.assertEqual(trio.run(self.ops.read, fh, bs * 4 - 1, bs * 3), data[-1:] + bytes(bs * 2 + 1) + b'z')
+
+    def test_cache(self):
+        inode = self.ops.db.create_inode(1, b'cached', 0, 0, 0o100644)
+        bs = self.ops.blksize
+        self.ops.db.update_blocks([(inode, 0, b'a' * bs), (inode, 2, b'c' * bs)])
+        self.ops.db.update_inode(inode, size=bs * 3)
+        fh = self.open(inode)
+        expected = b'a' * bs + b'\x00' * bs + b'c' * bs
+        self.assertEqual(trio.run(self.ops.read, fh, 0, bs * 3), expected)
+        self.assertEqual(len(self.ops.cache.blocks), 3)
+        # served from the cache without touching the database
+        self.ops.db.truncate_blocks(inode, 0)
+        self.assertEqual(trio.run(self.ops.read, fh, 0, bs * 3), expected)
+        self.ops.cache.discard(inode)
+        self.assertEqual(trio.run(self.ops.read, fh, 0, bs * 3), b'\x00' * bs * 3)
+
+    def test_cache_race(self):
+        inode = self.ops.db.create_inode(1, b'raced', 0, 0, 0o100644)
+        bs = self.ops.blksize
+        fh = self.open(inode)
+        trio.run(self.ops.write, fh, 0, b'o' * bs)
+        trio.run(self.ops.flush, fh)
+        self.ops.cache.discard(inode)
+
+        # a write lands after the reader missed both caches, but before it
+        # reads the old block from the database
+        def write_between(inode, idx):
+            self.ops._write(inode, 0, b'n' * bs)
+            return None
+
+        with unittest.mock.patch.object(self.ops.cache, 'get_block', side_effect=write_between):
+            self.ops._get_blocks(inode, 0, 0)
+        trio.run(self.ops.flush, fh)
+        self.assertEqual(trio.run(self.ops.read, fh, 0, bs), b'n' * bs)
+
+    def test_readahead(self):
+        inode = self.ops.db.create_inode(1, b'streamed', 0, 0, 0o100644)
+        bs = self.ops.blksize
+        data = os.urandom(bs * 64)
+        fh = self.open(inode)
+        trio.run(self.ops.write, fh, 0, data)
+        trio.run(self.ops.release, fh)
+        self.assertNotIn(fh, self.ops.handles)
+        self.ops.cache.discard(inode)
+        fh = self.open(inode)
+        with unittest.mock.patch.object(self.ops.db, 'get_blocks', wraps=self.ops.db.get_blocks) as get_blocks:
+            read = b''.join(trio.run(self.ops.read, fh, off, bs) for off in range(0, len(data), bs))
+        self.assertEqual(read, data)
+        # the window doubles as long as reads stay sequential
+        self.assertEqual(get_blocks.call_count, 6)
+        trio.run(self.ops.read, fh, bs * 3, bs)
+        self.assertEqual(self.ops.handles[fh].window, 0)
+
+    def test_cache_bounded(self):
+        cache = sqlfs.BlockCache(3 * (100 + sqlfs.BlockCache.overhead))
+        for idx in range(5):
+            cache.update_block(1, idx, b'x' * 100)
+        self.assertEqual(list(cache.blocks), [(1, 2), (1, 3), (1, 4)])
+        cache.get_block(1, 2)
+        cache.update_block(1, 5, b'x' * 100)
+        self.assertEqual(list(cache.blocks), [(1, 4), (1, 2), (1, 5)])
+        cache.truncate_blocks(1, 3)
+        self.assertEqual(list(cache.blocks), [(1, 2)])
+
+    def test_attr_cache(self):
+        ctx = types.SimpleNamespace(uid=0, gid=0)
+        fi, entry = trio.run(self.ops.create, 1, b'attrs', 0o100644, 0, ctx)
+        inode, fh = entry.st_ino, fi.fh
+        self.assertEqual(entry.attr_timeout, 300.0)
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_nlink, 1)
+        # served from the cache without touching the database
+        self.ops.db.update_inode(inode, mode=0o100600)
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_mode, 0o100644)
+        trio.run(self.ops.link, inode, 1, b'attrs2', ctx)
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_nlink, 2)
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_mode, 0o100600)
+        trio.run(self.ops.write, fh, 0, b'abc')
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_size, 3)
+        trio.run(self.ops.flush, fh)
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_blocks, self.ops.blksize >> 9)
+        trio.run(self.ops.unlink, 1, b'attrs', ctx)
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_nlink, 1)
+        trio.run(self.ops.forget, [(inode, 2)])
+        self.assertIsNone(self.ops.attrs.get(inode))
+
+    def test_readdir(self):
+        inodes = [self.ops.db.create_inode(1, b'entry%d' % i, 0, 0, 0o100644) for i in range(3)]
+
+        # readdir tokens can only come from the kernel
+        def readdir_reply(token, name, entry, next_id):
+            token.append((name, next_id))
+            return True
+
+        with unittest.mock.patch.object(sqlfs.pyfuse3, 'readdir_reply', readdir_reply):
+            token = []
+            trio.run(self.ops.readdir, 1, 0, token)
+            self.assertEqual([name for name, _ in token], [b'.', b'..', b'entry0', b'entry1', b'entry2'])
+            # listed entries are looked up and their attributes cached
+            self.assertEqual(sorted(self.ops.attrs.rows), inodes)
+            resumed = []
+            trio.run(self.ops.readdir, 1, token[2][1], resumed)
+            self.assertEqual([name for name, _ in resumed], [b'entry1', b'entry2'])
+
+    def test_xattrs(self):
+        ctx = types.SimpleNamespace(uid=0, gid=0)
+        inode = self.ops.db.create_inode(1, b'xattrs', 0, 0, 0o100644)
+        # answered from the cached inode row
+        trio.run(self.ops.getattr, inode, None)
+        self.ops.db.update_xattr(inode, b'user.hidden', b'1')
+        with self.assertRaises(sqlfs.pyfuse3.FUSEError):
+            trio.run(self.ops.getxattr, inode, b'user.hidden', ctx)
+        self.assertEqual(trio.run(self.ops.listxattr, inode, ctx), [])
+        trio.run(self.ops.setxattr, inode, b'user.name', b'value', ctx)
+        self.assertEqual(trio.run(self.ops.getxattr, inode, b'user.name', ctx), b'value')
+        self.assertEqual(sorted(trio.run(self.ops.listxattr, inode, ctx)), [b'user.hidden', b'user.name'])
+        trio.run(self.ops.removexattr, inode, b'user.name', ctx)
+        with self.assertRaises(sqlfs.pyfuse3.FUSEError):
+            trio.run(self.ops.removexattr, inode, b'user.name', ctx)
+
+    def test_keep_cache(self):
+        ctx = types.SimpleNamespace(uid=0, gid=0)
+        fi, entry = trio.run(self.ops.create, 1, b'kept', 0o100644, 0, ctx)
+        inode, fh = entry.st_ino, fi.fh
+        self.assertTrue(trio.run(self.ops.open, inode, os.O_RDONLY, ctx).keep_cache)
+        trio.run(self.ops.write, fh, 0, b'abc')
+        self.assertFalse(trio.run(self.ops.open, inode, os.O_RDONLY, ctx).keep_cache)
+        self.assertTrue(trio.run(self.ops.open, inode, os.O_RDONLY, ctx).keep_cache)
+        self.assertFalse(trio.run(self.ops.open, inode, os.O_RDWR | os.O_TRUNC, ctx).keep_cache)
+        bs = self.ops.blksize
+        trio.run(self.ops.write, fh, 0, b'a' * bs * 2)
+        self.assertFalse(trio.run(self.ops.open, inode, os.O_RDONLY, ctx).keep_cache)
+        mtime_ns = trio.run(self.ops.getattr, inode, ctx).st_mtime_ns
+        punch_hole = sqlfs.FALLOC_FL_PUNCH_HOLE | sqlfs.FALLOC_FL_KEEP_SIZE
+        trio.run(self.ops.fallocate, fh, punch_hole, 0, bs)
+        self.assertGreater(trio.run(self.ops.getattr, inode, ctx).st_mtime_ns, mtime_ns)
+        self.assertFalse(trio.run(self.ops.open, inode, os.O_RDONLY, ctx).keep_cache)
+        trio.run(self.ops.fallocate, fh, 0, 0, bs * 3)
+        self.assertFalse(trio.run(self.ops.open, inode, os.O_RDONLY, ctx).keep_cache)
+
+    def test_threaded(self):
+        self.ops = sqlfs.Operations(':memory:', key='unused', threaded=True)
+        inode = self.ops.db.create_inode(1, b'threaded', 0, 0, 0o100644)
+        fh = self.open(inode)
+
+        async def write_and_read():
+            async with trio.open_nursery() as nursery:
+                for i in range(8):
+                    nursery.start_soon(self.ops.write, fh, i * 10, bytes([65 + i]) * 10)
+            return await self.ops.read(fh, 0, 80)
+
+        self.assertEqual(trio.run(write_and_read), b''.join(bytes([65 + i]) * 10 for i in range(8)))
+
+    def test_readers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'fs.db')
+            self.ops = sqlfs.Operations(db_path, threaded=True, wal=True, synchronous='normal', readers=2)
+            self.assertTrue(self.ops.db.wal)
+            inode = self.ops.db.create_inode(1, b'readers', 0, 0, 0o100644)
+            fh = self.open(inode)
+            self.ops.db.commit()
+
+            async def write_and_read():
+                await self.ops.write(fh, 0, b'abcdef')
+                results = []
+                async with trio.open_nursery() as nursery:
+                    for _ in range(4):
+                        async def read():
+                            results.append(await self.ops.read(fh, 0, 6))
+                        nursery.start_soon(read)
+                return results
+
+            self.assertEqual(trio.run(write_and_read), [b'abcdef'] * 4)
+            self.ops.close()
+
+    def test_copy_file_range(self):
+        for dedup in (False, True):
+            self.ops = sqlfs.Operations(':memory:', key='unused', dedup=dedup)
+            bs = self.ops.blksize
+            src = self.ops.db.create_inode(1, b'src', 0, 0, 0o100644)
+            dst = self.ops.db.create_inode(1, b'dst', 0, 0, 0o100644)
+            src_fh, dst_fh = self.open(src), self.open(dst)
+            data = os.urandom(bs * 4) + bytes(bs * 2) + os.urandom(bs * 2)
+            trio.run(self.ops.write, src_fh, 0, data)
+            trio.run(self.ops.write, dst_fh, 0, b'y' * bs * 2)
+            trio.run(self.ops.flush, src_fh)
+            # aligned the same way, the middle blocks are copied in the database
+            self.assertEqual(trio.run(self.ops.copy_file_range, src_fh, 10, dst_fh, bs + 10, len(data), 0), len(data) - 10)
+            self.assertEqual(trio.run(self.ops.getattr, dst, None).st_size, bs + len(data))
+            self.assertEqual(trio.run(self.ops.read, dst_fh, 0, bs * 10), b'y' * (bs + 10) + data[10:])
+            # the hole is copied as a hole
+            self.assertEqual(trio.run(self.ops.lseek, dst_fh, bs * 6, os.SEEK_DATA), bs * 7)
+            if dedup:
+                refs = self.ops.db.conn.execute('SELECT SUM(refs) - COUNT(*) FROM chunk').fetchone()[0]
+                self.assertEqual(refs, 5)
+            # aligned differently, copied through read and write
+            self.assertEqual(trio.run(self.ops.copy_file_range, src_fh, 1, dst_fh, 0, bs * 2, 0), bs * 2)
+            self.assertEqual(trio.run(self.ops.read, dst_fh, 0, bs * 2), data[1:bs * 2 + 1])
+            # aligned the same way but too short to reach a block boundary
+            self.assertEqual(trio.run(self.ops.copy_file_range, src_fh, 5, dst_fh, 5, 10, 0), 10)
+            self.assertEqual(trio.run(self.ops.read, dst_fh, 0, bs * 2), data[1:6] + data[5:15] + data[16:bs * 2 + 1])
+
+    def test_copy_file_range_bounded(self):
+        self.ops = sqlfs.Operations(':memory:', key='unused', writeback_size=4 << 20)
+        self.ops.copy_size = 1 << 20
+        src = self.ops.db.create_inode(1, b'src', 0, 0, 0o100644)
+        dst = self.ops.db.create_inode(1, b'dst', 0, 0, 0o100644)
+        src_fh, dst_fh = self.open(src), self.open(dst)
+        data = os.urandom(16 << 20)
+        trio.run(self.ops.write, src_fh, 0, data)
+        trio.run(self.ops.flush, src_fh)
+        # aligned differently, copied a piece at a time through the
+        # write-back cache, which is flushed as it fills up
+        with unittest.mock.patch.object(self.ops, '_write', wraps=self.ops._write) as write:
+            self.assertEqual(trio.run(self.ops.copy_file_range, src_fh, 1, dst_fh, 0, len(data), 0), len(data) - 1)
+        self.assertEqual(max(len(args[2]) for args, _ in write.call_args_list), 1 << 20)
+        self.assertLess(self.ops.writeback.nbytes, 4 << 20)
+        self.assertEqual(trio.run(self.ops.read, dst_fh, 0, len(data)), data[1:])
+
+    def test_fallocate(self):
+        inode = self.ops.db.create_inode(1, b'fallocated', 0, 0, 0o100644)
+        fh = self.open(inode)
+        bs = self.ops.blksize
+        data = os.urandom(bs * 4)
+        trio.run(self.ops.write, fh, 0, data)
+        trio.run(self.ops.fallocate, fh, 0, 0, bs * 8)
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_size, bs * 8)
+        self.assertEqual(self.block_count(), 4)
+        keep_size = sqlfs.FALLOC_FL_KEEP_SIZE
+        trio.run(self.ops.fallocate, fh, keep_size | sqlfs.FALLOC_FL_PUNCH_HOLE, 10, bs * 2)
+        self.assertEqual(self.block_count(), 3)
+        expected = data[:10] + bytes(bs * 2) + data[bs * 2 + 10:] + bytes(bs * 4)
+        self.assertEqual(trio.run(self.ops.read, fh, 0, bs * 8), expected)
+        trio.run(self.ops.fallocate, fh, sqlfs.FALLOC_FL_ZERO_RANGE, bs * 3, bs * 6)
+        self.assertEqual(self.block_count(), 2)
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_size, bs * 9)
+        self.assertEqual(trio.run(self.ops.read, fh, 0, bs * 9), expected[:bs * 3] + bytes(bs * 6))
+        with self.assertRaises(sqlfs.pyfuse3.FUSEError):
+            trio.run(self.ops.fallocate, fh, sqlfs.FALLOC_FL_PUNCH_HOLE, 0, bs)
+
+    def test_stats(self):
+        ctx = types.SimpleNamespace(uid=0, gid=0)
+        self.ops = sqlfs.Operations(':memory:', key='unused', stats=True)
+        inode = self.ops.db.create_inode(1, b'measured', 0, 0, 0o100644)
+        fh = self.open(inode)
+        trio.run(self.ops.write, fh, 0, b'abc')
+        trio.run(self.ops.read, fh, 0, 3)
+        control = trio.run(self.ops.lookup, 1, b'.sqlfs', ctx).st_ino
+        stats = trio.run(self.ops.lookup, control, b'stats', ctx).st_ino
+        fi = trio.run(self.ops.open, stats, os.O_RDONLY, ctx)
+        self.assertTrue(fi.direct_io)
+        stats_fh = fi.fh
+        data = json.loads(trio.run(self.ops.read, stats_fh, 0, 1 << 20))
+        self.assertEqual(data['ops']['write']['count'], 1)
+        self.assertEqual((data['bytes_written'], data['bytes_read']), (3, 3))
+        with self.assertRaises(sqlfs.pyfuse3.FUSEError):
+            trio.run(self.ops.write, stats_fh, 0, b'x')
+        with self.assertRaises(sqlfs.pyfuse3.FUSEError):
+            trio.run(self.ops.mkdir, control, b'dir', 0o40755, ctx)
+        # the errors are counted too
+        self.assertEqual(self.ops.get_stats()['ops']['write']['errors'], 1)
+        # the control directory can't be removed or renamed, and is forgotten
+        # like any other inode
+        for op, args in ((self.ops.rmdir, (1, b'.sqlfs')), (self.ops.unlink, (1, b'.sqlfs')),
+                         (self.ops.rename, (1, b'.sqlfs', 1, b'other', 0))):
+            with self.assertRaises(sqlfs.pyfuse3.FUSEError):
+                trio.run(op, *args, ctx)
+        trio.run(self.ops.forget, [(stats, 1), (control, 2)])
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sqlfs.prof')
+            self.ops = sqlfs.Operations(':memory:', key='unused', threaded=True, profile=path)
+            inode = self.ops.db.create_inode(1, b'profiled', 0, 0, 0o100644)
+            fh = self.open(inode)
+            trio.run(self.ops.write, fh, 0, b'abc')
+            self.ops.close()
+            self.assertTrue(os.path.getsize(path))
+
+    def test_snapshot(self):
+        for threaded in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'snapshot.db')
+                self.ops = sqlfs.Operations(':memory:', key='unused', threaded=threaded)
+                self.ops.snapshot_pages = 1
+                inode = self.ops.db.create_inode(1, b'snapshot', 0, 0, 0o100644)
+                fh = self.open(inode)
+                data = os.urandom(self.ops.blksize * 16)
+
+                async def snapshot_while_writing():
+                    await self.ops.write(fh, 0, data)
+                    async with trio.open_nursery() as nursery:
+                        nursery.start_soon(self.ops.snapshot, path)
+                        for i in range(16):
+                            nursery.start_soon(self.ops.write, fh, len(data) + i, b'x')
+
+                trio.run(snapshot_while_writing)
+                restored = sqlfs.Operations(':memory:', key='unused', restore=path)
+                row = restored.db.get_inode_from_parent_and_name(1, b'snapshot')
+                self.assertGreaterEqual(row['size'], len(data))
+                fh = trio.run(restored.open, row['id'], os.O_RDONLY, None).fh
+                self.assertEqual(trio.run(restored.read, fh, 0, len(data)), data)
+
+    def test_forget(self):
+        ctx = types.SimpleNamespace(uid=0, gid=0)
+        fi, entry = trio.run(self.ops.create, 1, b'forgotten', 0o100644, 0, ctx)
+        inode, fh = entry.st_ino, fi.fh
+        trio.run(self.ops.write, fh, 0, b'abc')
+        trio.run(self.ops.flush, fh)
+        trio.run(self.ops.unlink, 1, b'forgotten', ctx)
+        # still open so it is kept around
+        self.assertEqual(trio.run(self.ops.read, fh, 0, 3), b'abc')
+        trio.run(self.ops.forget, [(inode, 1)])
+        self.assertIsNone(self.ops.db.get_inode_from_id(inode))
+        self.assertEqual(self.block_count(), 0)
+
+    def test_rename_dir(self):
+        ctx = types.SimpleNamespace(uid=0, gid=0)
+        a = trio.run(self.ops.mkdir, 1, b'a', 0o40755, ctx).st_ino
+        b = trio.run(self.ops.mkdir, 1, b'b', 0o40755, ctx).st_ino
+        c = trio.run(self.ops.mkdir, a, b'c', 0o40755, ctx).st_ino
+        self.assertEqual(trio.run(self.ops.getattr, a, None).st_nlink, 3)
+        trio.run(self.ops.rename, a, b'c', b, b'c', 0, ctx)
+        self.assertEqual(trio.run(self.ops.getattr, a, None).st_nlink, 2)
+        self.assertEqual(trio.run(self.ops.getattr, b, None).st_nlink, 3)
+        self.assertEqual(trio.run(self.ops.lookup, c, b'..', ctx).st_ino, b)
+
+    def test_unlink_forgotten(self):
+        ctx = types.SimpleNamespace(uid=0, gid=0)
+        entry = trio.run(self.ops.mkdir, 1, b'dir', 0o40755, ctx)
+        trio.run(self.ops.forget, [(entry.st_ino, 1)])
+        self.assertIsNotNone(self.ops.db.get_inode_from_id(entry.st_ino))
+        trio.run(self.ops.rmdir, 1, b'dir', ctx)
+        self.assertIsNone(self.ops.db.get_inode_from_id(entry.st_ino))
+        self.assertEqual(self.ops.db.get_inode_from_id(1)['nlink'], 2)
+
+    def test_block_size(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'fs.db')
+            self.ops = sqlfs.Operations(db_path, block_size=65536)
+            self.assertEqual(self.ops.blksize, 65536)
+            inode = self.ops.db.create_inode(1, b'large', 0, 0, 0o100644)
+            fh = self.open(inode)
+            data = bytes(range(256)) * 1024
+            trio.run(self.ops.write, fh, 100, data)
+            self.ops.close()
+            self.ops = sqlfs.Operations(db_path)
+            self.assertEqual(self.ops.blksize, 65536)
+            self.assertEqual(self.block_count(), 5)
+            fh = self.open(inode)
+            self.assertEqual(trio.run(self.ops.read, fh, 0, len(data) + 100), b'\x00' * 100 + data)
+            self.assertEqual(trio.run(self.ops.getattr, inode, None).st_blocks, 5 * 128)
+            self.ops.close()
+
+    def test_sparse(self):
+        inode = self.ops.db.create_inode(1, b'sparse', 0, 0, 0o100644)
+        fh = self.open(inode)
+        bs = self.ops.blksize
+        trio.run(self.ops.write, fh, bs * 4, b'a' * bs)
+        trio.run(self.ops.write, fh, bs * 8 + 10, b'b')
+        trio.run(self.ops.flush, fh)
+        self.assertEqual(self.block_count(), 2)
+        self.assertEqual(trio.run(self.ops.lseek, fh, 0, os.SEEK_DATA), bs * 4)
+        self.assertEqual(trio.run(self.ops.lseek, fh, bs * 4 + 1, os.SEEK_HOLE), bs * 5)
+        self.assertEqual(trio.run(self.ops.lseek, fh, bs * 5, os.SEEK_DATA), bs * 8)
+        self.assertEqual(trio.run(self.ops.lseek, fh, bs * 8, os.SEEK_HOLE), bs * 8 + 11)
+        with self.assertRaises(sqlfs.pyfuse3.FUSEError):
+            trio.run(self.ops.lseek, fh, bs * 9, os.SEEK_DATA)
+        # overwriting with zeros punches a hole
+        trio.run(self.ops.write, fh, bs * 4, b'\x00' * bs)
+        trio.run(self.ops.flush, fh)
+        self.assertEqual(self.block_count(), 1)
+        self.assertEqual(trio.run(self.ops.getattr, inode, None).st_blocks, bs >> 9)
+
+    def test_truncate_zeros_tail(self):
+        inode = self.ops.db.create_inode(1, b'truncated', 0, 0, 0o100644)
+        fh = self.open(inode)
+        trio.run(self.ops.write, fh, 0, b'abcdef')
+        attr = types.SimpleNamespace(st_size=2)
+        fields = types.SimpleNamespace(
+            update_size=True, update_mode=False, update_uid=False, update_gid=False,
+            update_mtime=False, update_atime=False, update_ctime=False)
+        trio.run(self.ops.setattr, inode, attr, fields, None, None)
+        attr.st_size = 6
+        trio.run(self.ops.setattr, inode, attr, fields, None, None)
+        self.assertEqual(trio.run(self.ops.read, fh, 0, 6), b'ab\x00\x00\x00\x00')